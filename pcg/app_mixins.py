@@ -6,6 +6,8 @@ from typing import TYPE_CHECKING
 import redis
 import pymongo
 
+from pcg.profiling import Profiler
+
 # make linter happy, can't finde attribute "errors" in pymongo
 if TYPE_CHECKING:
     from pymongo.errors import ConnectionFailure
@@ -54,3 +56,12 @@ class AppRedisMixin:
         except redis.exceptions.ConnectionError:
             return False
         return False
+
+
+class AppProfilerMixin:
+    """Add on-demand profiler, dumps are tagged with app uuid"""
+
+    @functools.lru_cache()
+    def get_profiler(self, directory: str) -> Profiler:
+        """Return profiler writing results into directory"""
+        return Profiler(directory, tag=str(getattr(self, "app_uuid", "pcg")))
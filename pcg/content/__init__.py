@@ -0,0 +1 @@
+"""Content processing helpers"""
@@ -0,0 +1,258 @@
+"""SimHash fingerprints and banded index to find near-duplicate pages.
+
+Fingerprint splitted into `max_distance + 1` bands, by pigeonhole principle
+two fingerprints within `max_distance` bits share at least one band exactly,
+so lookup is a few hash table hits instead of scan over all fingerprints.
+
+>> index = SimHashIndex()
+>> index.add("http://example.com/1", simhash(text))
+>> index.is_duplicate(simhash(another_text))
+"""
+import re
+import hashlib
+import threading
+from typing import Dict, Set, List, Tuple, Iterable, Optional
+
+import redis
+
+
+FINGERPRINT_BITS = 64
+TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+
+
+def tokenize(text: str) -> List[str]:
+    """Split text into lowercased words"""
+    return TOKEN_RE.findall(text.lower())
+
+
+def shingles(tokens: List[str], size: int = 3) -> Iterable[str]:
+    """Return word n-grams, whole text if it's shorter than n-gram"""
+    if len(tokens) <= size:
+        yield " ".join(tokens)
+        return
+    for idx in range(len(tokens) - size + 1):
+        yield " ".join(tokens[idx : idx + size])
+
+
+def feature_hash(feature: str) -> int:
+    """Stable 64 bit hash of the feature"""
+    digest = hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big")
+
+
+def simhash(text: str, shingle_size: int = 3) -> int:
+    """Compute 64 bit SimHash fingerprint of the text"""
+    weights: Dict[str, int] = {}
+    for feature in shingles(tokenize(text), shingle_size):
+        weights[feature] = weights.get(feature, 0) + 1
+
+    vector = [0] * FINGERPRINT_BITS
+    for feature, weight in weights.items():
+        value = feature_hash(feature)
+        for bit in range(FINGERPRINT_BITS):
+            if value & (1 << bit):
+                vector[bit] += weight
+            else:
+                vector[bit] -= weight
+
+    fingerprint = 0
+    for bit, total in enumerate(vector):
+        if total > 0:
+            fingerprint |= 1 << bit
+    return fingerprint
+
+
+def hamming_distance(first: int, second: int) -> int:
+    """Number of different bits"""
+    return bin(first ^ second).count("1")
+
+
+class MemoryBandStorage:
+    """Keep bands in process memory"""
+
+    def __init__(self):
+        self.bands: Dict[Tuple[int, int], Set[Tuple[int, str]]] = {}
+        self.lock = threading.Lock()
+
+    def add_many(self, items: List[Tuple[Tuple[int, int], int, str]]):
+        """Store (band, fingerprint, key) items"""
+        with self.lock:
+            for band, fingerprint, key in items:
+                self.bands.setdefault(band, set()).add((fingerprint, key))
+
+    def get_many(
+        self, bands: List[Tuple[int, int]]
+    ) -> List[Set[Tuple[int, str]]]:
+        """Return (fingerprint, key) pairs stored for each band"""
+        with self.lock:
+            return [set(self.bands.get(band, set())) for band in bands]
+
+    def get_and_add(
+        self,
+        bands: List[Tuple[int, int]],
+        items: List[Tuple[Tuple[int, int], int, str]],
+    ) -> List[Set[Tuple[int, str]]]:
+        """Atomically return pairs stored for bands, then store items"""
+        with self.lock:
+            result = [set(self.bands.get(band, set())) for band in bands]
+            for band, fingerprint, key in items:
+                self.bands.setdefault(band, set()).add((fingerprint, key))
+        return result
+
+
+class RedisBandStorage:
+    """Keep bands in redis sets, so index shared between workers.
+    Use `AppRedisMixin.get_redis_pool()` to get client."""
+
+    def __init__(
+        self,
+        client: redis.Redis,
+        prefix: str = "pcg:simhash",
+        ttl: Optional[int] = None,
+    ):
+        self.client = client
+        self.prefix = prefix
+        self.ttl = ttl
+
+    def band_key(self, band: Tuple[int, int]) -> str:
+        """Redis key for the band"""
+        return "{}:{}:{:x}".format(self.prefix, band[0], band[1])
+
+    def queue_add(self, pipe, items: List[Tuple[Tuple[int, int], int, str]]):
+        """Add SADD commands for (band, fingerprint, key) items to pipeline"""
+        for band, fingerprint, key in items:
+            band_key = self.band_key(band)
+            pipe.sadd(band_key, "{:x}:{}".format(fingerprint, key))
+            if self.ttl is not None:
+                pipe.expire(band_key, self.ttl)
+
+    @staticmethod
+    def parse_members(members) -> Set[Tuple[int, str]]:
+        """Convert set members into (fingerprint, key) pairs"""
+        pairs = set()
+        for member in members:
+            if isinstance(member, bytes):
+                member = member.decode("utf-8")
+            fingerprint, key = member.split(":", 1)
+            pairs.add((int(fingerprint, 16), key))
+        return pairs
+
+    def add_many(self, items: List[Tuple[Tuple[int, int], int, str]]):
+        """Store (band, fingerprint, key) items"""
+        pipe = self.client.pipeline(transaction=False)
+        self.queue_add(pipe, items)
+        pipe.execute()
+
+    def get_many(
+        self, bands: List[Tuple[int, int]]
+    ) -> List[Set[Tuple[int, str]]]:
+        """Return (fingerprint, key) pairs stored for each band"""
+        pipe = self.client.pipeline(transaction=False)
+        for band in bands:
+            pipe.smembers(self.band_key(band))
+        return [self.parse_members(members) for members in pipe.execute()]
+
+    def get_and_add(
+        self,
+        bands: List[Tuple[int, int]],
+        items: List[Tuple[Tuple[int, int], int, str]],
+    ) -> List[Set[Tuple[int, str]]]:
+        """Return pairs stored for bands and store items in one MULTI/EXEC
+        transaction, so concurrent workers see each other's items"""
+        pipe = self.client.pipeline(transaction=True)
+        for band in bands:
+            pipe.smembers(self.band_key(band))
+        self.queue_add(pipe, items)
+        result = pipe.execute()
+        return [self.parse_members(members) for members in result[: len(bands)]]
+
+
+class SimHashIndex:
+    """Banded index of SimHash fingerprints"""
+
+    def __init__(self, max_distance: int = 3, storage=None):
+        self.max_distance = max_distance
+        self.storage = storage if storage is not None else MemoryBandStorage()
+
+        # split fingerprint into max_distance + 1 bands of almost equal size
+        self.band_count = max_distance + 1
+        band_size, rest = divmod(FINGERPRINT_BITS, self.band_count)
+        self.masks: List[Tuple[int, int]] = []
+        shift = 0
+        for idx in range(self.band_count):
+            size = band_size + (1 if idx < rest else 0)
+            self.masks.append((shift, (1 << size) - 1))
+            shift += size
+
+    def bands(self, fingerprint: int) -> List[Tuple[int, int]]:
+        """Return (band number, band value) for fingerprint"""
+        return [
+            (idx, (fingerprint >> shift) & mask)
+            for idx, (shift, mask) in enumerate(self.masks)
+        ]
+
+    def add(self, key: str, fingerprint: int):
+        """Add fingerprint into index"""
+        self.add_many([(key, fingerprint)])
+
+    def add_many(self, items: Iterable[Tuple[str, int]]):
+        """Add (key, fingerprint) pairs into index"""
+        self.storage.add_many(
+            [
+                (band, fingerprint, key)
+                for key, fingerprint in items
+                for band in self.bands(fingerprint)
+            ]
+        )
+
+    def near_duplicates(self, fingerprint: int) -> List[str]:
+        """Return keys of near-duplicates of the fingerprint"""
+        return self.near_duplicates_many([fingerprint])[0]
+
+    def near_duplicates_many(self, fingerprints: List[int]) -> List[List[str]]:
+        """Return keys of near-duplicates for each fingerprint,
+        single storage roundtrip for all of them"""
+        bands = [band for fp in fingerprints for band in self.bands(fp)]
+        candidates = self.storage.get_many(bands)
+
+        result = []
+        for idx, fingerprint in enumerate(fingerprints):
+            chunk = candidates[
+                idx * self.band_count : (idx + 1) * self.band_count
+            ]
+            result.append(self.match(fingerprint, chunk))
+        return result
+
+    def match(
+        self, fingerprint: int, candidates: List[Set[Tuple[int, str]]]
+    ) -> List[str]:
+        """Return keys of candidates close enough to fingerprint"""
+        keys = {
+            key
+            for pairs in candidates
+            for other, key in pairs
+            if hamming_distance(fingerprint, other) <= self.max_distance
+        }
+        return sorted(keys)
+
+    def is_duplicate(self, fingerprint: int) -> bool:
+        """Check if near-duplicate of fingerprint was seen"""
+        return len(self.near_duplicates(fingerprint)) > 0
+
+    def is_duplicate_many(self, fingerprints: List[int]) -> List[bool]:
+        """Batch version of `is_duplicate`"""
+        return [
+            len(keys) > 0 for keys in self.near_duplicates_many(fingerprints)
+        ]
+
+    def check_and_add(self, key: str, text: str) -> bool:
+        """Fingerprint text and remember it, return True if near-duplicate
+        was seen before. Lookup and insert are one atomic step, so of two
+        workers getting the same page only one sees it as new; the page
+        is stored even if it's a duplicate."""
+        fingerprint = simhash(text)
+        bands = self.bands(fingerprint)
+        candidates = self.storage.get_and_add(
+            bands, [(band, fingerprint, key) for band in bands]
+        )
+        return len(self.match(fingerprint, candidates)) > 0
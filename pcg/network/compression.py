@@ -0,0 +1,101 @@
+"""Content-encoding negotiation and transfer accounting.
+
+Brotli and zstd are advertised only when urllib3 is able to decode them,
+i.e. the codec package is installed and supported by urllib3 version
+(brotli/brotlicffi and urllib3>=1.25 for br, zstandard and urllib3>=2 for
+zstd), otherwise we stay on gzip.
+"""
+import logging
+import threading
+from typing import List, Iterator
+
+import requests
+from urllib3.util.request import ACCEPT_ENCODING
+
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 64 * 1024
+# preferred encodings, best first
+PREFERENCE = ("zstd", "br", "gzip", "deflate")
+
+
+def available_encodings() -> List[str]:
+    """Content encodings urllib3 is able to decode, best first"""
+    supported = {
+        encoding.strip() for encoding in ACCEPT_ENCODING.split(",")
+    }
+    return [encoding for encoding in PREFERENCE if encoding in supported]
+
+
+def accept_encoding() -> str:
+    """Value for Accept-Encoding header"""
+    return ", ".join(available_encodings())
+
+
+def wire_bytes(res: requests.Response) -> int:
+    """Number of bytes read from socket for response body,
+    before content decoding"""
+    tell = getattr(res.raw, "tell", None)
+    if tell is None:
+        return 0
+    try:
+        return tell()
+    except (OSError, ValueError):
+        return 0
+
+
+class TransferStats:
+    """Count body bytes received over the wire and after decoding"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.responses = 0
+        self.compressed_bytes = 0
+        self.decompressed_bytes = 0
+
+    def add(self, compressed: int, decompressed: int):
+        """Add numbers of single response"""
+        with self.lock:
+            self.responses += 1
+            self.compressed_bytes += compressed
+            self.decompressed_bytes += decompressed
+
+    def add_response(self, res: requests.Response):
+        """Add downloaded (not streamed) response"""
+        self.add(wire_bytes(res), len(res.content or b""))
+
+    def ratio(self) -> float:
+        """Compression ratio, decompressed / compressed"""
+        if self.compressed_bytes == 0:
+            return 1.0
+        return self.decompressed_bytes / self.compressed_bytes
+
+    def as_dict(self):
+        """Return stats as dictionary"""
+        return {
+            "responses": self.responses,
+            "compressed_bytes": self.compressed_bytes,
+            "decompressed_bytes": self.decompressed_bytes,
+            "ratio": self.ratio(),
+        }
+
+
+def iter_decoded(
+    res: requests.Response, stats: TransferStats, chunk_size: int = CHUNK_SIZE
+) -> Iterator[bytes]:
+    """Stream decompressed body of `stream=True` response chunk by chunk,
+    count bytes when body is over"""
+    decompressed = 0
+    try:
+        for chunk in res.iter_content(chunk_size):
+            decompressed += len(chunk)
+            yield chunk
+    finally:
+        stats.add(wire_bytes(res), decompressed)
+        logger.debug(
+            "%s: %s bytes received, %s decoded",
+            res.url,
+            wire_bytes(res),
+            decompressed,
+        )
@@ -0,0 +1,267 @@
+"""Adaptive per-host concurrency.
+
+AIMD (additive increase, multiplicative decrease) controller: each success
+adds about one slot per "window" of requests, throttling responses (429,
+503), exceptions and slow responses cut host limit in half. Controller is
+fed by `AIMDEvents` and gates `HTTPRequest` through `limiter` argument.
+
+>> controller = AIMDController(initial=4, max_limit=64)
+>> fetcher = BatchFetcher(controller, max_workers=32)
+>> responses = fetcher.fetch([Request("GET", url) for url in urls])
+"""
+import time
+import logging
+import threading
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+from urllib.parse import urlsplit
+
+import requests
+
+from .http_request import HTTPRequest, HTTPRequestEvents
+
+
+logger = logging.getLogger(__name__)
+
+# responses meaning server asks us to slow down
+THROTTLE_STATUSES = (429, 503)
+
+
+def url_host(url: str) -> str:
+    """Return host the concurrency is controlled for"""
+    return urlsplit(url).netloc.lower()
+
+
+class HostState:
+    """Concurrency state of single host"""
+
+    __slots__ = ("limit", "in_flight", "last_decrease")
+
+    def __init__(self, limit: float):
+        self.limit = limit
+        self.in_flight = 0
+        self.last_decrease = 0.0
+
+    @property
+    def allowed(self) -> int:
+        """Whole number of slots, at least one so host is never locked out"""
+        return max(1, int(self.limit))
+
+
+class AIMDController:
+    """Per-host limit of in-flight requests driven by request outcomes"""
+
+    def __init__(
+        self,
+        initial: float = 4,
+        min_limit: float = 1,
+        max_limit: float = 64,
+        increase: float = 1.0,
+        decrease: float = 0.5,
+        latency_threshold: Optional[float] = None,
+        cooldown: float = 1.0,
+    ):
+        if min_limit < 1:
+            raise ValueError("min_limit should be at least 1")
+        self.initial = initial
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.increase = increase
+        self.decrease = decrease
+        # responses slower than this are treated as congestion signal
+        self.latency_threshold = latency_threshold
+        # decrease limit at most once per cooldown, one burst of 429s
+        # shouldn't drop it to the minimum
+        self.cooldown = cooldown
+
+        self.hosts: Dict[str, HostState] = {}
+        self.condition = threading.Condition()
+
+    def state(self, url: str) -> HostState:
+        """Return host state, should be called under condition lock"""
+        host = url_host(url)
+        if host not in self.hosts:
+            self.hosts[host] = HostState(self.initial)
+        return self.hosts[host]
+
+    def limit(self, url: str) -> int:
+        """Current number of allowed in-flight requests to url host"""
+        with self.condition:
+            return self.state(url).allowed
+
+    def acquire(self, url: str, timeout: Optional[float] = None) -> bool:
+        """Wait for free slot for url host"""
+        with self.condition:
+            state = self.state(url)
+            acquired = self.condition.wait_for(
+                lambda: state.in_flight < state.allowed, timeout
+            )
+            if acquired:
+                state.in_flight += 1
+            return acquired
+
+    def release(self, url: str):
+        """Return slot of url host"""
+        with self.condition:
+            state = self.state(url)
+            state.in_flight = max(0, state.in_flight - 1)
+            self.condition.notify_all()
+
+    @contextlib.contextmanager
+    def slot(self, url: str):
+        """Hold slot of url host inside the block"""
+        self.acquire(url)
+        try:
+            yield
+        finally:
+            self.release(url)
+
+    def on_success(self, url: str, latency: Optional[float] = None):
+        """Additive increase, slow response is congestion signal"""
+        if (
+            self.latency_threshold is not None
+            and latency is not None
+            and latency > self.latency_threshold
+        ):
+            self.on_congestion(url)
+            return
+
+        with self.condition:
+            state = self.state(url)
+            state.limit = min(
+                self.max_limit, state.limit + self.increase / state.limit
+            )
+            self.condition.notify_all()
+
+    def on_congestion(self, url: str):
+        """Multiplicative decrease"""
+        with self.condition:
+            state = self.state(url)
+            now = time.monotonic()
+            if now - state.last_decrease < self.cooldown:
+                return
+            state.last_decrease = now
+            state.limit = max(self.min_limit, state.limit * self.decrease)
+            logger.debug(
+                "Concurrency of %s decreased to %s",
+                url_host(url),
+                state.allowed,
+            )
+
+    def observe(self, res: requests.Response):
+        """Feed response outcome"""
+        url = original_url(res)
+        if res.status_code in THROTTLE_STATUSES:
+            self.on_congestion(url)
+        elif res.ok:
+            self.on_success(url, res.elapsed.total_seconds())
+
+
+def original_url(res: requests.Response) -> str:
+    """Url requested before redirects, the one slot was taken for"""
+    return res.history[0].url if res.history else res.url
+
+
+class AIMDEvents(HTTPRequestEvents):
+    """Feed request outcomes into controller, pass events further"""
+
+    def __init__(
+        self,
+        controller: AIMDController,
+        events: Optional[HTTPRequestEvents] = None,
+    ):
+        self.controller = controller
+        self.events = events if events is not None else HTTPRequestEvents()
+
+    def on_send(self):
+        self.events.on_send()
+
+    def on_success(self, res):
+        self.controller.observe(res)
+        self.events.on_success(res)
+
+    def on_fail(self, req, res):
+        self.controller.observe(res)
+        self.events.on_fail(req, res)
+
+    def on_exception(self, req, exc):
+        self.controller.on_congestion(req.url)
+        self.events.on_exception(req, exc)
+
+    def on_skip(self, req, res, skip):
+        self.events.on_skip(req, res, skip)
+
+    def on_deadline(self, req, exc):
+        self.events.on_deadline(req, exc)
+
+
+class BatchFetcher:
+    """Fetch batch of requests with thread pool, per-host concurrency is
+    limited by controller. Pool and sessions are reused between batches,
+    call `close()` or use as context manager to release them."""
+
+    def __init__(
+        self,
+        controller: AIMDController,
+        http_factory=None,
+        max_workers: int = 16,
+    ):
+        self.controller = controller
+        self.http_factory = http_factory or self.default_http
+        self.max_workers = max_workers
+        self.local = threading.local()
+        self.executor: Optional[ThreadPoolExecutor] = None
+        # instances created by worker threads, closed in close()
+        self.instances: List[HTTPRequest] = []
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """Stop worker threads and close their sessions"""
+        with self.lock:
+            executor, self.executor = self.executor, None
+            instances, self.instances = self.instances, []
+        if executor is not None:
+            executor.shutdown(wait=True)
+        for http in instances:
+            http.session.close()
+
+    def default_http(self) -> HTTPRequest:
+        """HTTPRequest gated by and feeding the controller"""
+        return HTTPRequest(
+            events=AIMDEvents(self.controller), limiter=self.controller
+        )
+
+    @property
+    def http(self) -> HTTPRequest:
+        """HTTPRequest is not thread safe, one per thread"""
+        if not hasattr(self.local, "http"):
+            self.local.http = self.http_factory()
+            with self.lock:
+                self.instances.append(self.local.http)
+        return self.local.http
+
+    def get_executor(self) -> ThreadPoolExecutor:
+        """Return thread pool, create it on first use"""
+        with self.lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(
+                    max_workers=self.max_workers
+                )
+            return self.executor
+
+    def fetch(
+        self, reqs: List[requests.Request], proxies=None
+    ) -> List[Optional[requests.Response]]:
+        """Return responses in order of requests"""
+        return list(
+            self.get_executor().map(
+                lambda req: self.http.repeat_request(req, proxies), reqs
+            )
+        )
@@ -1,35 +1,149 @@
 """Requests lib wrapper to provide general error handling and
 request repeating pattern. I use it inside celery tasks."""
 import time
+import socket
 import logging
-from typing import Optional, List, Dict
+from typing import Optional, List, Dict, Any, Callable, Iterator
+from urllib.parse import urlsplit
 
 import requests
+import urllib3
+
+from .compression import (
+    TransferStats,
+    accept_encoding,
+    iter_decoded,
+    wire_bytes,
+)
 
 #  from user_agent import generate_user_agent  # type: ignore
 
 
 logger = logging.getLogger(__name__)
-DEFAULT_CONFIG = {
-    "request_timeout": 10,
+DEFAULT_CONFIG: Dict[str, Any] = {
+    "request_timeout": 10,  # used if connect or read timeout is not set
+    "request_connect_timeout": None,
+    "request_read_timeout": None,
+    # total time of repeat_request call, including retries and sleeps
+    "request_deadline": None,
     "request_backoff_timeout": 1,
     "request_retries": 3,
     "request_sleep_on_error_time": 1,
     "change_proxy_on_retry": True,
     "change_ua_on_retry": True,
+    # advertise br and zstd when codecs are installed
+    "request_compression": False,
+    # download limits, transfer aborted without retries when exceeded
+    "request_max_body_size": None,  # bytes
+    "request_allowed_content_types": None,  # ["text/*", "application/json"]
+    "request_max_download_time": None,  # seconds
+    # per-domain overrides of limits above without "request_" prefix,
+    # {"example.com": {"max_body_size": 1024}}, applies to subdomains too
+    "request_domain_limits": {},
 }
+LIMITS = ("max_body_size", "allowed_content_types", "max_download_time")
+# body is read by pieces up to this size, whatever has arrived is returned
+READ_SIZE = 64 * 1024
+# urllib3<2 has no read1(), read() waits for whole piece there
+SMALL_READ_SIZE = 1024
+
+# magic bytes to guess content type when server didn't send it
+CONTENT_SIGNATURES = [
+    (b"%PDF", "application/pdf"),
+    (b"PK\x03\x04", "application/zip"),
+    (b"\x1f\x8b", "application/gzip"),
+    (b"\x89PNG", "image/png"),
+    (b"GIF8", "image/gif"),
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"<?xml", "application/xml"),
+    (b"<!doctype html", "text/html"),
+    (b"<html", "text/html"),
+]
 
 
 def generate_user_agent():
     return "android"
 
 
+class DownloadSkipped(Exception):
+    """Download aborted because response exceeded limits"""
+
+    BODY_SIZE = "body_size"
+    CONTENT_TYPE = "content_type"
+    DOWNLOAD_TIME = "download_time"
+
+    def __init__(self, reason: str, value, limit):
+        super().__init__(
+            "Download skipped: {} {} exceeds {}".format(reason, value, limit)
+        )
+        self.reason = reason
+        self.value = value
+        self.limit = limit
+
+
+class DeadlineExceeded(Exception):
+    """Request didn't succeed within deadline"""
+
+    def __init__(self, deadline: float):
+        super().__init__("Deadline of {}s exceeded".format(deadline))
+        self.deadline = deadline
+
+
+def sniff_content_type(chunk: bytes) -> str:
+    """Guess content type by first bytes of body"""
+    head = chunk[:64].lstrip().lower()
+    for signature, content_type in CONTENT_SIGNATURES:
+        if head.startswith(signature.lower()):
+            return content_type
+    if b"\x00" in chunk[:1024]:
+        return "application/octet-stream"
+    return "text/plain"
+
+
+def response_socket(res: requests.Response) -> Optional[socket.socket]:
+    """Socket body of streamed response is read from, None for mocked
+    responses or released connections"""
+    connection = getattr(res.raw, "connection", None)
+    return getattr(connection, "sock", None)
+
+
+def release_on_close(res: requests.Response, release: Callable[[], None]):
+    """Call release once, when response is closed"""
+    close = res.close
+    is_released = False
+
+    def close_and_release():
+        nonlocal is_released
+        try:
+            close()
+        finally:
+            if not is_released:
+                is_released = True
+                release()
+
+    res.close = close_and_release  # type: ignore
+
+
+def is_content_type_allowed(content_type: str, allowed: List[str]) -> bool:
+    """Match mime type against list, "text/*" matches any text"""
+    mime = content_type.split(";")[0].strip().lower()
+    for pattern in allowed:
+        pattern = pattern.lower()
+        if pattern.endswith("/*") and mime.startswith(pattern[:-1]):
+            return True
+        if mime == pattern:
+            return True
+    return False
+
+
 class HTTPRequestEvents:
     """Implement events handling for requests
 
     >> on_send()  # just before send request
     >> on_success()  # if request succeed
     >> on_fail()  # if request fail
+    >> on_skip()  # if download aborted by limits
+    >> on_deadline()  # if request didn't succeed within deadline
     """
 
     def on_send(self):
@@ -44,21 +158,37 @@ class HTTPRequestEvents:
     def on_exception(self, req, exc):
         """On request exception"""
 
+    def on_skip(self, req, res, skip):
+        """On download aborted, skip is DownloadSkipped instance"""
+
+    def on_deadline(self, req, exc):
+        """On deadline exceeded, exc is DeadlineExceeded instance"""
+
 
 class HTTPRequest:
     """Wrapper around requests library provides shortcuts
     for common functions to work with HTTP requests
     """
 
-    def __init__(self, config=None, headers=None, events=None):
+    def __init__(
+        self,
+        config=None,
+        headers=None,
+        events=None,
+        profiler=None,
+        limiter=None,
+    ):
         # create session according to config
         self.session = requests.Session()
 
-        # load conf
-        self.config = DEFAULT_CONFIG
+        # load conf, copy defaults so instances don't share settings
+        self.config = dict(DEFAULT_CONFIG)
         if config is not None:
             self.config.update(config)
 
+        if self.config["request_compression"]:
+            self.session.headers["accept-encoding"] = accept_encoding()
+
         if headers is not None:
             self.session.headers.update(headers)
 
@@ -67,6 +197,15 @@ class HTTPRequest:
         else:
             self.events = HTTPRequestEvents()
 
+        # pcg.profiling.Profiler to profile requests on demand
+        self.profiler = profiler
+        # pcg.network.concurrency.AIMDController to limit in-flight
+        # requests per host
+        self.limiter = limiter
+
+        # body bytes received over the wire vs after decoding
+        self.transfer_stats = TransferStats()
+
         self.errors = []
 
     def last_error(self):
@@ -79,8 +218,203 @@ class HTTPRequest:
         new_timeout = timeout + self.config["request_backoff_timeout"]
         return new_timeout
 
-    def repeat_request(self, req: requests.Request, proxies=None):
+    def get_limits(self, url: str, limits: Optional[Dict] = None) -> Dict:
+        """Merge download limits: config, then most specific domain
+        override, then limits of the request"""
+        result = {name: self.config["request_" + name] for name in LIMITS}
+
+        host = (urlsplit(url).hostname or "").lower()
+        domain_limits = self.config["request_domain_limits"] or {}
+        parts = host.split(".")
+        for idx in reversed(range(len(parts))):
+            result.update(domain_limits.get(".".join(parts[idx:]), {}))
+
+        if limits is not None:
+            result.update(limits)
+        return result
+
+    def check_headers(self, res: requests.Response, limits: Dict):
+        """Check response headers against limits"""
+        max_size = limits["max_body_size"]
+        length = res.headers.get("content-length", "")
+        if max_size is not None and length.isdigit():
+            if int(length) > max_size:
+                raise DownloadSkipped(
+                    DownloadSkipped.BODY_SIZE, int(length), max_size
+                )
+
+        allowed = limits["allowed_content_types"]
+        content_type = res.headers.get("content-type")
+        if allowed is not None and content_type:
+            if not is_content_type_allowed(content_type, allowed):
+                raise DownloadSkipped(
+                    DownloadSkipped.CONTENT_TYPE, content_type, allowed
+                )
+
+    def get_timeout(
+        self, time_left: Optional[float], max_read: Optional[float] = None
+    ):
+        """Return (connect, read) timeouts for session.send,
+        both are cut to time left until deadline, read timeout is also
+        cut to `max_read` (download time limit)"""
+        connect = self.config["request_connect_timeout"]
+        if connect is None:
+            connect = self.config["request_timeout"]
+        read = self.config["request_read_timeout"]
+        if read is None:
+            read = self.config["request_timeout"]
+
+        if time_left is not None:
+            connect = time_left if connect is None else min(connect, time_left)
+            read = time_left if read is None else min(read, time_left)
+        # zero timeout is not allowed, zero limit is checked on download
+        if max_read:
+            read = max_read if read is None else min(read, max_read)
+
+        if connect is None and read is None:
+            return None
+        return (connect, read)
+
+    def iter_body(
+        self, res: requests.Response, stop_at: Optional[float] = None
+    ) -> Iterator[bytes]:
+        """Yield decoded body of streamed response as soon as any data
+        arrives. Socket timeout is cut to time left until `stop_at` before
+        each read, iteration just ends when it's reached."""
+        sock = response_socket(res)
+        read_timeout = sock.gettimeout() if sock is not None else None
+        read1 = getattr(res.raw, "read1", None)
+
+        while True:
+            if stop_at is not None:
+                left = stop_at - time.monotonic()
+                if left <= 0:
+                    return
+                if sock is not None:
+                    if read_timeout is not None:
+                        left = min(read_timeout, left)
+                    sock.settimeout(left)
+
+            # same exceptions as Response.iter_content() raises
+            try:
+                if read1 is not None:
+                    chunk = read1(READ_SIZE, decode_content=True)
+                else:
+                    chunk = res.raw.read(SMALL_READ_SIZE, decode_content=True)
+            except (
+                urllib3.exceptions.ReadTimeoutError,
+                socket.timeout,
+            ) as exc:
+                if stop_at is not None and time.monotonic() >= stop_at:
+                    return
+                raise requests.exceptions.ConnectionError(exc)
+            except urllib3.exceptions.ProtocolError as exc:
+                raise requests.exceptions.ChunkedEncodingError(exc)
+            except urllib3.exceptions.DecodeError as exc:
+                raise requests.exceptions.ContentDecodingError(exc)
+
+            if not chunk:
+                return
+            yield chunk
+
+    def download(
+        self,
+        res: requests.Response,
+        limits: Dict,
+        started: float,
+        deadline_at: Optional[float] = None,
+        deadline: Optional[float] = None,
+        truncate: bool = False,
+    ):
+        """Download body of streamed response chunk by chunk, abort as soon
+        as it exceeds limits or `deadline` (ends at `deadline_at`), no
+        single read waits past them.
+        With `truncate` (error responses) content type is not checked and
+        body is cut at size and time limits instead of being skipped.
+        Response is closed when body is read, so connection and limiter
+        slot are released."""
+        max_size = limits["max_body_size"]
+        max_time = limits["max_download_time"]
+        allowed = limits["allowed_content_types"]
+        # sniff type by first chunk if server didn't send it
+        sniff = (
+            not truncate
+            and allowed is not None
+            and not res.headers.get("content-type")
+        )
+
+        stop_at = deadline_at
+        if max_time is not None:
+            download_end = started + max_time
+            stop_at = (
+                download_end if stop_at is None else min(stop_at, download_end)
+            )
+
+        chunks: List[bytes] = []
+        size = 0
+        try:
+            for chunk in self.iter_body(res, stop_at):
+                if sniff and not chunks:
+                    content_type = sniff_content_type(chunk)
+                    if not is_content_type_allowed(content_type, allowed):
+                        raise DownloadSkipped(
+                            DownloadSkipped.CONTENT_TYPE, content_type, allowed
+                        )
+
+                size += len(chunk)
+                if max_size is not None and size > max_size:
+                    if not truncate:
+                        raise DownloadSkipped(
+                            DownloadSkipped.BODY_SIZE, size, max_size
+                        )
+                    chunks.append(chunk[: len(chunk) - (size - max_size)])
+                    break
+                chunks.append(chunk)
+        finally:
+            self.transfer_stats.add(wire_bytes(res), size)
+
+        # body is over or reading stopped at time limit
+        now = time.monotonic()
+        if (
+            deadline is not None
+            and deadline_at is not None
+            and now > deadline_at
+        ):
+            raise DeadlineExceeded(deadline)
+        if max_time is not None and now - started > max_time and not truncate:
+            raise DownloadSkipped(
+                DownloadSkipped.DOWNLOAD_TIME, now - started, max_time
+            )
+
+        # pylint: disable=protected-access
+        res._content = b"".join(chunks)
+        res._content_consumed = True
+        res.close()
+
+    def repeat_request(
+        self,
+        req: requests.Request,
+        proxies=None,
+        stream: bool = False,
+        limits: Optional[Dict] = None,
+        deadline: Optional[float] = None,
+    ):
         """Repeat request according to request config.
+        With `stream=True` body is not downloaded, read it with
+        `iter_content()` or close response, limiter slot is held until
+        then. Only headers are checked against limits in this case.
+
+        `limits` overrides download limits from config for this request:
+        {"max_body_size": ..., "allowed_content_types": [...],
+        "max_download_time": ...}. If successful response exceeds them
+        download is aborted without retries, `on_skip` event fired and None
+        returned. Error responses are failed and retried as usual, limits
+        only cut their body.
+
+        `deadline` (seconds, "request_deadline" from config by default)
+        bounds whole call including retries and backoff sleeps, each
+        attempt gets only time left as timeout. When it's exceeded
+        `on_deadline` event fired and None returned.
 
         NOTE: out of the box solution
         >> session.mount('https://', HTTPAdapter(max_retries=...))
@@ -89,22 +423,171 @@ class HTTPRequest:
         It doesnt work when server terminate connection while
         response is downloaded.
         """
+        if self.profiler is not None:
+            with self.profiler.scope():
+                return self.send_with_retries(
+                    req, proxies, stream, limits, deadline
+                )
+        return self.send_with_retries(req, proxies, stream, limits, deadline)
+
+    def iter_content(self, res: requests.Response, chunk_size=64 * 1024):
+        """Yield decompressed body of streamed response by chunks,
+        body size is added into `transfer_stats`. Response is closed when
+        body is over."""
+        yield from iter_decoded(res, self.transfer_stats, chunk_size)
+        res.close()
+
+    def send(
+        self,
+        prepped: requests.PreparedRequest,
+        proxies,
+        stream: bool,
+        deadline_at: Optional[float] = None,
+        max_read: Optional[float] = None,
+    ):
+        """Send single request, wait for free slot if limiter is set.
+        Slot of streamed response is released when response is closed.
+        Return None if there was no free slot until `deadline_at`."""
+        if self.limiter is None:
+            timeout = self.get_timeout(self.time_left(deadline_at), max_read)
+            return self.session.send(
+                prepped, proxies=proxies, stream=stream, timeout=timeout
+            )
 
+        url = prepped.url
+        if not self.limiter.acquire(url, self.time_left(deadline_at)):
+            return None
+        # time spent waiting for slot is not available for request
+        time_left = self.time_left(deadline_at)
+        if time_left is not None and time_left <= 0:
+            self.limiter.release(url)
+            return None
+        timeout = self.get_timeout(time_left, max_read)
+        try:
+            res = self.session.send(
+                prepped, proxies=proxies, stream=stream, timeout=timeout
+            )
+        except BaseException:
+            self.limiter.release(url)
+            raise
+        if stream:
+            release_on_close(res, lambda: self.limiter.release(url))
+        else:
+            self.limiter.release(url)
+        return res
+
+    @staticmethod
+    def time_left(deadline_at: Optional[float]) -> Optional[float]:
+        """Seconds left until deadline, None if there is no deadline"""
+        if deadline_at is None:
+            return None
+        return deadline_at - time.monotonic()
+
+    def deadline_exceeded(
+        self, req: requests.Request, res, exc: DeadlineExceeded
+    ):
+        """Record deadline exceeded outcome"""
+        self.errors.append(
+            {
+                "__type": "deadline",
+                "exception": exc,
+                "response": res,
+                "request": req,
+            }
+        )
+        self.events.on_deadline(req, exc)
+
+    def send_with_retries(
+        self,
+        req: requests.Request,
+        proxies=None,
+        stream: bool = False,
+        limits: Optional[Dict] = None,
+        deadline: Optional[float] = None,
+    ):
+        """Send request until success or retries are exhausted"""
         backoff_timer = 0  # increase sleep time after each fail
         self.errors = []  # drop errors from previous call
 
         prepped = self.session.prepare_request(req)
+        limits = self.get_limits(prepped.url, limits)
+        # limits are checked against headers and body
+        is_limited = any(value is not None for value in limits.values())
+
+        if deadline is None:
+            deadline = self.config["request_deadline"]
+        deadline_at = None
+        if deadline is not None:
+            deadline_at = time.monotonic() + deadline
+        # body is downloaded by us to check deadline between chunks
+        is_streamed = is_limited or deadline_at is not None
 
         res = None
         for idx, _ in enumerate(range(self.config["request_retries"])):
+            time_left = self.time_left(deadline_at)
+            if time_left is not None and time_left <= 0:
+                self.deadline_exceeded(req, res, DeadlineExceeded(deadline))
+                return None
+
             if idx > 0:  # if not first request
                 # change user agent
                 if self.config["change_ua_on_retry"]:
                     prepped.headers["user-agent"] = generate_user_agent()
 
             self.events.on_send()
+            started = time.monotonic()
             try:
-                res = self.session.send(prepped, proxies=proxies)
+                try:
+                    res = self.send(
+                        prepped,
+                        proxies,
+                        stream or is_streamed,
+                        deadline_at,
+                        limits["max_download_time"],
+                    )
+                except requests.exceptions.ReadTimeout:
+                    # read timeout is cut to download time limit
+                    elapsed = time.monotonic() - started
+                    max_time = limits["max_download_time"]
+                    if max_time is None or elapsed < max_time:
+                        raise
+                    res = None
+                    raise DownloadSkipped(
+                        DownloadSkipped.DOWNLOAD_TIME, elapsed, max_time
+                    )
+                if res is None:  # waited for limiter slot until deadline
+                    raise DeadlineExceeded(deadline)
+                # error responses go through fail and retry path,
+                # limits only cut their body
+                if is_limited and res.ok:
+                    self.check_headers(res, limits)
+                if is_streamed and not stream:
+                    self.download(
+                        res,
+                        limits,
+                        started,
+                        deadline_at,
+                        deadline,
+                        truncate=not res.ok,
+                    )
+            except DownloadSkipped as skip:
+                if res is not None:
+                    res.close()
+                self.errors.append(
+                    {
+                        "__type": "skipped",
+                        "exception": skip,
+                        "response": res,
+                        "request": req,
+                    }
+                )
+                self.events.on_skip(req, res, skip)
+                return None
+            except DeadlineExceeded as exc:
+                if res is not None:
+                    res.close()
+                self.deadline_exceeded(req, res, exc)
+                return None
             except requests.exceptions.RequestException as exc:
                 self.errors.append(
                     {
@@ -127,12 +610,31 @@ class HTTPRequest:
                         }
                     )
                     self.events.on_fail(req, res)
+                    if stream and idx + 1 < self.config["request_retries"]:
+                        res.close()  # release connection before retry
 
                     backoff_timer = self.backoff_timeout(backoff_timer)
-                    time.sleep(backoff_timer)
+                    time_left = self.time_left(deadline_at)
+                    if time_left is None:
+                        time.sleep(backoff_timer)
+                    else:  # don't sleep past deadline
+                        time.sleep(max(0, min(backoff_timer, time_left)))
                     continue
                 else:
+                    if not stream and not is_streamed:
+                        self.transfer_stats.add_response(res)
                     self.events.on_success(res)
                     return res
 
+        # last attempt timed out because of deadline
+        time_left = self.time_left(deadline_at)
+        last_error = self.last_error()
+        if (
+            time_left is not None
+            and time_left <= 0
+            and last_error is not None
+            and last_error["__type"] == "exception"
+        ):
+            self.deadline_exceeded(req, res, DeadlineExceeded(deadline))
+            return None
         return res
@@ -0,0 +1,205 @@
+"""Fetch robots.txt once per host and keep parsed rules with ttl.
+
+Raw robots files are optionally shared between workers through redis,
+parsed rules are kept in process memory.
+
+>> redis_client = app.get_redis_pool(uri)
+>> robots = RobotsCache(user_agent="mybot", redis_client=redis_client)
+>> robots.can_fetch_many(urls)
+>> robots.wait(url)  # respect Crawl-delay before request
+"""
+import json
+import time
+import logging
+import threading
+from typing import Dict, List, Tuple, Optional, Iterable
+from urllib.parse import urlsplit
+from urllib.robotparser import RobotFileParser
+
+import redis
+from requests import Request
+
+from .http_request import HTTPRequest
+
+
+logger = logging.getLogger(__name__)
+
+
+def robots_host(url: str) -> str:
+    """Return scheme://host part of the url robots.txt belongs to"""
+    parts = urlsplit(url)
+    return "{}://{}".format(parts.scheme, parts.netloc.lower())
+
+
+def build_parser(status: Optional[int], text: str):
+    """Create robots parser according to robots.txt fetch result:
+    - no response or server error, disallow everything for now
+    - 401, 403 disallow everything
+    - other 4xx means there is no robots.txt, allow everything
+    """
+    parser = RobotFileParser()
+    if status is None or status >= 500 or status in (401, 403):
+        parser.parse(["User-agent: *", "Disallow: /"])
+    elif status >= 400:
+        parser.parse([])
+    else:
+        parser.parse(text.splitlines())
+    parser.modified()
+    return parser
+
+
+class RobotsCache:
+    """Cache of robots.txt rules per host"""
+
+    def __init__(
+        self,
+        http: Optional[HTTPRequest] = None,
+        user_agent: str = "*",
+        ttl: int = 24 * 60 * 60,
+        error_ttl: int = 10 * 60,
+        redis_client: Optional[redis.Redis] = None,
+        redis_prefix: str = "pcg:robots",
+    ):
+        # robots.txt is cheap to lose, don't waste time on retries
+        self.http = http or HTTPRequest(
+            config={"request_retries": 1, "request_backoff_timeout": 0}
+        )
+        self.user_agent = user_agent
+        self.ttl = ttl
+        self.error_ttl = error_ttl
+        self.redis_client = redis_client
+        self.redis_prefix = redis_prefix
+
+        # host -> (expire time, parser)
+        self.parsers: Dict[str, Tuple[float, RobotFileParser]] = {}
+        # host -> time of last (or already scheduled) request, used for
+        # pacing, time.monotonic() based
+        self.last_access: Dict[str, float] = {}
+        self.lock = threading.Lock()
+
+    def redis_key(self, host: str) -> str:
+        """Redis key for host robots.txt"""
+        return "{}:{}".format(self.redis_prefix, host)
+
+    def fetch(self, host: str) -> Tuple[Optional[int], str]:
+        """Fetch robots.txt for host, return (status, text)"""
+        res = self.http.repeat_request(
+            Request("GET", "{}/robots.txt".format(host))
+        )
+        if res is None:
+            logger.warning("Can't fetch robots.txt for %s", host)
+            return None, ""
+        return res.status_code, res.text if res.ok else ""
+
+    def ttl_for(self, status: Optional[int]) -> int:
+        """Keep server errors for short time only"""
+        if status is None or status >= 500:
+            return self.error_ttl
+        return self.ttl
+
+    def load(self, hosts: Iterable[str]):
+        """Make sure rules for all hosts are in memory, redis is asked
+        for all missing hosts at once"""
+        now = time.time()
+        missing = [
+            host
+            for host in set(hosts)
+            if host not in self.parsers or self.parsers[host][0] < now
+        ]
+        if not missing:
+            return
+
+        cached: List[Tuple[Optional[bytes], int]] = [(None, 0)] * len(missing)
+        if self.redis_client is not None:
+            pipe = self.redis_client.pipeline(transaction=False)
+            for host in missing:
+                pipe.get(self.redis_key(host))
+                pipe.ttl(self.redis_key(host))
+            try:
+                result = pipe.execute()
+                cached = list(zip(result[::2], result[1::2]))
+            except redis.exceptions.RedisError as exc:
+                # shared cache is optimization only, fetch robots ourselves
+                logger.warning("Can't read robots.txt from redis: %s", exc)
+
+        for host, (raw, ttl) in zip(missing, cached):
+            if raw is not None:
+                data = json.loads(raw)
+                status, text = data["status"], data["text"]
+                ttl = ttl if ttl > 0 else self.ttl_for(status)
+            else:
+                status, text = self.fetch(host)
+                ttl = self.ttl_for(status)
+                self.share(host, ttl, status, text)
+            self.parsers[host] = (now + ttl, build_parser(status, text))
+
+    def share(self, host: str, ttl: int, status: Optional[int], text: str):
+        """Store robots.txt in redis for other workers"""
+        # redis rejects zero ttl, such results aren't worth sharing anyway
+        if self.redis_client is None or ttl <= 0:
+            return
+        try:
+            self.redis_client.setex(
+                self.redis_key(host),
+                ttl,
+                json.dumps({"status": status, "text": text}),
+            )
+        except redis.exceptions.RedisError as exc:
+            logger.warning("Can't store robots.txt in redis: %s", exc)
+
+    def get_parser(self, url: str) -> RobotFileParser:
+        """Return robots rules for the url host"""
+        host = robots_host(url)
+        self.load([host])
+        return self.parsers[host][1]
+
+    def can_fetch(self, url: str, user_agent: Optional[str] = None) -> bool:
+        """Check if url allowed by robots.txt"""
+        return self.can_fetch_many([url], user_agent)[0]
+
+    def can_fetch_many(
+        self, urls: List[str], user_agent: Optional[str] = None
+    ) -> List[bool]:
+        """Check batch of urls, each host robots.txt is fetched once"""
+        user_agent = user_agent or self.user_agent
+        self.load(robots_host(url) for url in urls)
+        return [
+            self.parsers[robots_host(url)][1].can_fetch(user_agent, url)
+            for url in urls
+        ]
+
+    def crawl_delay(
+        self, url: str, user_agent: Optional[str] = None
+    ) -> Optional[float]:
+        """Return Crawl-delay of the url host"""
+        return self.crawl_delays([url], user_agent)[0]
+
+    def crawl_delays(
+        self, urls: List[str], user_agent: Optional[str] = None
+    ) -> List[Optional[float]]:
+        """Return Crawl-delay for batch of urls"""
+        user_agent = user_agent or self.user_agent
+        self.load(robots_host(url) for url in urls)
+
+        delays: List[Optional[float]] = []
+        for url in urls:
+            delay = self.parsers[robots_host(url)][1].crawl_delay(user_agent)
+            delays.append(float(delay) if delay is not None else None)
+        return delays
+
+    def wait(self, url: str, user_agent: Optional[str] = None) -> float:
+        """Sleep until Crawl-delay since previous request to the same host
+        passed, return time slept. Concurrent callers get successive
+        slots, each one Crawl-delay after previous."""
+        host = robots_host(url)
+        delay = self.crawl_delay(url, user_agent) or 0
+        with self.lock:
+            now = time.monotonic()
+            next_at = now
+            if host in self.last_access:
+                next_at = max(now, self.last_access[host] + delay)
+            self.last_access[host] = next_at
+        sleep_time = next_at - now
+        if sleep_time > 0:
+            time.sleep(sleep_time)
+        return sleep_time
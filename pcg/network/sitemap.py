@@ -0,0 +1,282 @@
+"""Streaming sitemap parser.
+
+Sitemaps (plain or gzipped) are downloaded with `stream=True` and fed into
+incremental xml parser chunk by chunk, so memory usage doesn't depend on
+sitemap size. Child sitemaps of sitemap index are fetched concurrently.
+
+>> fetcher = SitemapFetcher()
+>> for entry in fetcher.iter_urls("http://example.com/sitemap.xml",
+>>                                since=datetime(2020, 1, 1)):
+>>     print(entry.loc, entry.lastmod)
+"""
+import re
+import zlib
+import queue
+import logging
+import datetime
+import threading
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+from typing import NamedTuple, Optional, Iterable, Iterator, List
+
+from requests import Request
+
+from .http_request import HTTPRequest
+
+
+logger = logging.getLogger(__name__)
+
+GZIP_MAGIC = b"\x1f\x8b"
+W3C_DATETIME_RE = re.compile(
+    r"^(?P<year>\d{4})(?:-(?P<month>\d{2})(?:-(?P<day>\d{2})"
+    r"(?:T(?P<hour>\d{2}):(?P<minute>\d{2})"
+    r"(?::(?P<second>\d{2})(?:\.\d+)?)?"
+    r"(?P<tz>Z|[+-]\d{2}:?\d{2})?)?)?)?$"
+)
+
+
+class SitemapEntry(NamedTuple):
+    """Single <url> or <sitemap> element"""
+
+    kind: str  # "url" or "sitemap"
+    loc: str
+    lastmod: Optional[datetime.datetime] = None
+    changefreq: Optional[str] = None
+    priority: Optional[float] = None
+
+
+def as_utc(moment: Optional[datetime.datetime]):
+    """Make datetime timezone aware, naive ones are considered UTC"""
+    if moment is None or moment.tzinfo is not None:
+        return moment
+    return moment.replace(tzinfo=datetime.timezone.utc)
+
+
+def parse_lastmod(value: Optional[str]) -> Optional[datetime.datetime]:
+    """Parse W3C datetime used in sitemaps: 2020, 2020-01-01,
+    2020-01-01T10:00+03:00 etc."""
+    if not value:
+        return None
+    match = W3C_DATETIME_RE.match(value.strip())
+    if match is None:
+        return None
+
+    parts = match.groupdict()
+    tzinfo = datetime.timezone.utc
+    if parts["tz"] and parts["tz"] != "Z":
+        sign = -1 if parts["tz"][0] == "-" else 1
+        offset = parts["tz"][1:].replace(":", "")
+        tzinfo = datetime.timezone(
+            sign
+            * datetime.timedelta(hours=int(offset[:2]), minutes=int(offset[2:]))
+        )
+
+    try:
+        return datetime.datetime(
+            int(parts["year"]),
+            int(parts["month"] or 1),
+            int(parts["day"] or 1),
+            int(parts["hour"] or 0),
+            int(parts["minute"] or 0),
+            int(parts["second"] or 0),
+            tzinfo=tzinfo,
+        )
+    except ValueError:
+        return None
+
+
+def local_name(tag: str) -> str:
+    """Strip namespace from tag"""
+    return tag.rsplit("}", 1)[-1]
+
+
+def decompress(chunks: Iterable[bytes]) -> Iterator[bytes]:
+    """Ungzip chunks if data is gzipped (.xml.gz sitemaps)"""
+    decompressor = None
+    is_first = True
+    for chunk in chunks:
+        if not chunk:
+            continue
+        if is_first and chunk.startswith(GZIP_MAGIC):
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        is_first = False
+        if decompressor is not None:
+            yield decompressor.decompress(chunk)
+        else:
+            yield chunk
+    if decompressor is not None:
+        yield decompressor.flush()
+
+
+def parse_sitemap(chunks: Iterable[bytes]) -> Iterator[SitemapEntry]:
+    """Incrementally parse sitemap or sitemap index from chunks of bytes"""
+    parser: ET.XMLPullParser = ET.XMLPullParser(events=("start", "end"))
+    root: Optional[ET.Element] = None
+
+    for chunk in decompress(chunks):
+        parser.feed(chunk)
+        for item in parser.read_events():
+            # only start/end events are requested, those carry elements
+            event, elem = item[0], item[-1]
+            if not isinstance(elem, ET.Element):
+                continue
+            if event == "start":
+                if root is None:
+                    root = elem
+                continue
+
+            kind = local_name(elem.tag)
+            if kind not in ("url", "sitemap"):
+                continue
+
+            fields = {
+                local_name(child.tag): (child.text or "").strip()
+                for child in elem
+            }
+            if fields.get("loc"):
+                try:
+                    priority = float(fields["priority"])
+                except (KeyError, ValueError):
+                    priority = None
+                yield SitemapEntry(
+                    kind=kind,
+                    loc=fields["loc"],
+                    lastmod=parse_lastmod(fields.get("lastmod")),
+                    changefreq=fields.get("changefreq") or None,
+                    priority=priority,
+                )
+            # drop processed elements, keep memory constant
+            if root is not None:
+                root.clear()
+    parser.close()
+
+
+class SitemapFetcher:
+    """Fetch sitemaps and sitemap indexes"""
+
+    # marker, child sitemap processing is done
+    DONE = object()
+
+    def __init__(
+        self,
+        http_factory=HTTPRequest,
+        max_workers: int = 4,
+        max_depth: int = 3,
+        chunk_size: int = 64 * 1024,
+        queue_size: int = 1000,
+    ):
+        # HTTPRequest is not thread safe, each thread gets own instance
+        self.http_factory = http_factory
+        self.max_workers = max_workers
+        self.max_depth = max_depth
+        self.chunk_size = chunk_size
+        self.queue_size = queue_size
+        self.local = threading.local()
+
+    @property
+    def http(self) -> HTTPRequest:
+        """Return HTTPRequest instance for current thread"""
+        if not hasattr(self.local, "http"):
+            self.local.http = self.http_factory()
+        return self.local.http
+
+    def iter_entries(self, url: str) -> Iterator[SitemapEntry]:
+        """Fetch single sitemap and yield its entries"""
+        res = self.http.repeat_request(Request("GET", url), stream=True)
+        if res is None or not res.ok:
+            logger.warning("Can't fetch sitemap: %s", url)
+            if res is not None:
+                res.close()
+            return
+
+        try:
+            yield from parse_sitemap(
+                self.http.iter_content(res, self.chunk_size)
+            )
+        except ET.ParseError as exc:
+            logger.warning("Broken sitemap %s: %s", url, exc)
+        finally:
+            res.close()
+
+    @staticmethod
+    def is_fresh(entry: SitemapEntry, since: Optional[datetime.datetime]):
+        """Entries without lastmod are always fresh"""
+        if since is None or entry.lastmod is None:
+            return True
+        return entry.lastmod >= since
+
+    def walk(
+        self, url: str, since: Optional[datetime.datetime], depth: int = 0
+    ) -> Iterator[SitemapEntry]:
+        """Yield url entries of sitemap, nested indexes are processed
+        sequentially"""
+        for entry in self.iter_entries(url):
+            if not self.is_fresh(entry, since):
+                continue
+            if entry.kind == "url":
+                yield entry
+            elif depth < self.max_depth:
+                yield from self.walk(entry.loc, since, depth + 1)
+
+    def iter_urls(
+        self, url: str, since: Optional[datetime.datetime] = None
+    ) -> Iterator[SitemapEntry]:
+        """Yield url entries of sitemap or sitemap index,
+        filter them by lastmod if `since` provided"""
+        since = as_utc(since)
+        children: List[str] = []
+        for entry in self.iter_entries(url):
+            if not self.is_fresh(entry, since):
+                continue
+            if entry.kind == "url":
+                yield entry
+            else:
+                children.append(entry.loc)
+
+        if children:
+            yield from self.iter_children(children, since)
+
+    def iter_children(
+        self, children: List[str], since: Optional[datetime.datetime]
+    ) -> Iterator[SitemapEntry]:
+        """Fetch child sitemaps concurrently, pass entries through bounded
+        queue so slow consumer doesn't make workers buffer everything"""
+        results: queue.Queue = queue.Queue(maxsize=self.queue_size)
+        stop = threading.Event()
+
+        def put(item) -> bool:
+            while not stop.is_set():
+                try:
+                    results.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def worker(url: str):
+            if stop.is_set():  # consumer gone, skip pending sitemaps
+                return
+            try:
+                for entry in self.walk(url, since, depth=1):
+                    if not put(entry):
+                        return
+            except Exception:  # pylint: disable=broad-except
+                logger.exception("Sitemap processing failed: %s", url)
+            finally:
+                put(self.DONE)
+
+        executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        for child in children:
+            executor.submit(worker, child)
+
+        try:
+            done = 0
+            while done < len(children):
+                item = results.get()
+                if item is self.DONE:
+                    done += 1
+                    continue
+                yield item
+        finally:
+            stop.set()
+            executor.shutdown(wait=False)
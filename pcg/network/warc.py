@@ -0,0 +1,395 @@
+"""Write fetched responses into WARC/1.1 files.
+
+Each record is compressed as a separate gzip member, so any record can be
+read back by seeking to its offset. Alongside warc files writer keeps CDX
+index with offsets of response records. Writer can be shared between
+threads:
+
+>> writer = WARCWriter("/data/warc", prefix="crawl")
+>> http = HTTPRequest(events=WARCEvents(writer))
+>> http.repeat_request(Request("GET", "http://example.com"))
+>> writer.close()
+"""
+import os
+import gzip
+import uuid
+import base64
+import hashlib
+import logging
+import datetime
+import tempfile
+import threading
+from typing import IO, Optional, List, Tuple, Iterable, Iterator, Union
+from urllib.parse import urlsplit
+
+import requests
+
+from .http_request import HTTPRequestEvents
+
+
+logger = logging.getLogger(__name__)
+
+WARC_VERSION = "WARC/1.1"
+CHUNK_SIZE = 64 * 1024
+# keep bodies in memory up to this size, spool to disk otherwise
+SPOOL_MAX_SIZE = 1024 * 1024
+# headers describing transfer of the original body, not valid once
+# requests decoded it
+TRANSFER_HEADERS = ("content-encoding", "transfer-encoding", "content-length")
+CDX_HEADER = " CDX N b a m s k r M S V g\n"
+
+
+def warc_date(moment: Optional[datetime.datetime] = None) -> str:
+    """Return WARC-Date formatted timestamp"""
+    moment = moment or datetime.datetime.utcnow()
+    return moment.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def record_id() -> str:
+    """Return new WARC-Record-ID"""
+    return "<urn:uuid:{}>".format(uuid.uuid4())
+
+
+def as_str(value: Union[str, bytes]) -> str:
+    """Header names and values may be bytes"""
+    if isinstance(value, bytes):
+        return value.decode("iso-8859-1")
+    return value
+
+
+def surt(url: str) -> str:
+    """Return SURT-like key used to sort CDX index lines
+    http://www.Example.com/path?q=1 -> com,example)/path?q=1
+    """
+    parts = urlsplit(url)
+    host = (parts.hostname or "").lower()
+    if host.startswith("www."):
+        host = host[4:]
+    key = ",".join(reversed(host.split("."))) + ")"
+    key += parts.path or "/"
+    if parts.query:
+        key += "?" + parts.query
+    return key.lower()
+
+
+class BodySpool:
+    """Response body spooled to disk with its length and digest"""
+
+    def __init__(self) -> None:
+        self.spool: IO[bytes] = tempfile.SpooledTemporaryFile(
+            max_size=SPOOL_MAX_SIZE
+        )
+        self.sha1 = hashlib.sha1()
+        self.length = 0
+
+    def write(self, chunk: bytes):
+        """Append chunk of the body"""
+        self.sha1.update(chunk)
+        self.spool.write(chunk)
+        self.length += len(chunk)
+
+    def digest(self) -> str:
+        """WARC-Payload-Digest value"""
+        return "sha1:" + base64.b32encode(self.sha1.digest()).decode()
+
+    def close(self):
+        """Drop spooled body"""
+        self.spool.close()
+
+
+class WARCWriter:
+    """Streaming WARC/1.1 writer with per-record gzip and size-based
+    rotation of output files."""
+
+    def __init__(
+        self,
+        directory: str,
+        prefix: str = "pcg",
+        max_file_size: int = 1024 ** 3,
+        software: str = "py-crawling-goodies",
+    ):
+        self.directory = directory
+        self.prefix = prefix
+        self.max_file_size = max_file_size
+        self.software = software
+
+        os.makedirs(directory, exist_ok=True)
+        self.serial = 0
+        self.filename: Optional[str] = None
+        self.warc_file: Optional[IO[bytes]] = None
+        self.lock = threading.Lock()
+
+        index_path = os.path.join(directory, "{}.cdx".format(prefix))
+        is_new_index = not os.path.exists(index_path)
+        self.index_file = open(index_path, "a")
+        if is_new_index:
+            self.index_file.write(CDX_HEADER)
+            self.index_file.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """Close current warc file and index"""
+        if self.warc_file is not None:
+            self.warc_file.close()
+            self.warc_file = None
+        if not self.index_file.closed:
+            self.index_file.close()
+
+    def open_next_file(self):
+        """Close current warc file and start new one"""
+        if self.warc_file is not None:
+            self.warc_file.close()
+
+        self.serial += 1
+        self.filename = "{}-{}-{:05d}.warc.gz".format(
+            self.prefix,
+            datetime.datetime.utcnow().strftime("%Y%m%d%H%M%S"),
+            self.serial,
+        )
+        path = os.path.join(self.directory, self.filename)
+        logger.info("Writing warc file: %s", path)
+        self.warc_file = open(path, "ab")
+        self.write_warcinfo()
+
+    def ensure_file(self):
+        """Open warc file if there is none or current one is full"""
+        if (
+            self.warc_file is None
+            or self.warc_file.tell() >= self.max_file_size
+        ):
+            self.open_next_file()
+
+    def write_warcinfo(self):
+        """Write warcinfo record in the beginning of each file"""
+        block = "software: {}\r\nformat: WARC File Format 1.1\r\n".format(
+            self.software
+        ).encode("utf-8")
+        headers = [
+            ("WARC-Type", "warcinfo"),
+            ("WARC-Record-ID", record_id()),
+            ("WARC-Date", warc_date()),
+            ("WARC-Filename", self.filename),
+            ("Content-Type", "application/warc-fields"),
+        ]
+        self.write_record(headers, [block], len(block))
+
+    def write_record(
+        self,
+        headers: List[Tuple[str, str]],
+        chunks: Iterable[bytes],
+        length: int,
+    ) -> Tuple[int, int]:
+        """Write single record as separate gzip member,
+        return (offset, compressed length)"""
+        assert self.warc_file is not None
+        offset = self.warc_file.tell()
+
+        head = [WARC_VERSION]
+        head.extend("{}: {}".format(name, value) for name, value in headers)
+        head.append("Content-Length: {}".format(length))
+
+        with gzip.GzipFile(fileobj=self.warc_file, mode="wb") as member:
+            member.write(("\r\n".join(head) + "\r\n\r\n").encode("utf-8"))
+            for chunk in chunks:
+                member.write(chunk)
+            member.write(b"\r\n\r\n")
+
+        return offset, self.warc_file.tell() - offset
+
+    def write_response(self, res: requests.Response):
+        """Write request and response records for downloaded response.
+
+        Body of `stream=True` response belongs to the caller, it's never
+        read here, use `tee()` to archive it while it's consumed.
+        """
+        # pylint: disable=protected-access
+        if not res._content_consumed:
+            raise ValueError(
+                "Body of streamed response is not downloaded, use tee()"
+            )
+        body = BodySpool()
+        try:
+            body.write(res.content or b"")
+            self.write_spooled(res, body)
+        finally:
+            body.close()
+
+    def tee(
+        self, res: requests.Response, chunks: Iterable[bytes]
+    ) -> Iterator[bytes]:
+        """Pass body chunks through to the caller and write records when
+        body is over, nothing is written if consumer stopped early
+
+        >> for chunk in writer.tee(res, http.iter_content(res)):
+        >>     parser.feed(chunk)
+        """
+        body = BodySpool()
+        try:
+            for chunk in chunks:
+                body.write(chunk)
+                yield chunk
+            self.write_spooled(res, body)
+        finally:
+            body.close()
+
+    def write_spooled(self, res: requests.Response, body: "BodySpool"):
+        """Write records for response with spooled (decoded) body"""
+        url = res.url
+        now = datetime.datetime.utcnow()
+        moment = warc_date(now)
+        response_id = record_id()
+        response_head = self.response_head(res, body.length)
+        request_block = self.request_block(res.request)
+        payload_digest = body.digest()
+
+        # file is shared between threads, records and index lines
+        # of one response must not interleave with others
+        with self.lock:
+            self.ensure_file()
+            body.spool.seek(0)
+            offset, record_length = self.write_record(
+                [
+                    ("WARC-Type", "response"),
+                    ("WARC-Record-ID", response_id),
+                    ("WARC-Date", moment),
+                    ("WARC-Target-URI", url),
+                    ("WARC-Payload-Digest", payload_digest),
+                    ("Content-Type", "application/http; msgtype=response"),
+                ],
+                self.iter_chain(response_head, body.spool),
+                len(response_head) + body.length,
+            )
+
+            self.write_record(
+                [
+                    ("WARC-Type", "request"),
+                    ("WARC-Record-ID", record_id()),
+                    ("WARC-Date", moment),
+                    ("WARC-Target-URI", url),
+                    ("WARC-Concurrent-To", response_id),
+                    ("Content-Type", "application/http; msgtype=request"),
+                ],
+                [request_block],
+                len(request_block),
+            )
+
+            self.index_file.write(
+                " ".join(
+                    [
+                        surt(url),
+                        now.strftime("%Y%m%d%H%M%S"),
+                        url,
+                        self.mime_type(res),
+                        str(res.status_code),
+                        payload_digest.split(":", 1)[1],
+                        "-",
+                        "-",
+                        str(record_length),
+                        str(offset),
+                        self.filename or "-",
+                    ]
+                )
+                + "\n"
+            )
+            self.index_file.flush()
+
+    @staticmethod
+    def mime_type(res: requests.Response) -> str:
+        """Return mime type of the response for the index"""
+        content_type = res.headers.get("content-type", "")
+        return content_type.split(";")[0].strip() or "-"
+
+    @staticmethod
+    def iter_chain(head: bytes, spool: IO[bytes]) -> Iterable[bytes]:
+        """Yield http head and then spooled body by chunks"""
+        yield head
+        while True:
+            chunk = spool.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+
+    @staticmethod
+    def response_head(res: requests.Response, length: int) -> bytes:
+        """Build http status line and headers of the response, body is
+        stored decoded so transfer headers are replaced"""
+        version = getattr(res.raw, "version", 11)
+        lines = [
+            "HTTP/{}.{} {} {}".format(
+                version // 10, version % 10, res.status_code, res.reason or ""
+            ).rstrip()
+        ]
+        for name, value in res.headers.items():
+            if name.lower() in TRANSFER_HEADERS:
+                continue
+            lines.append("{}: {}".format(name, value))
+        lines.append("Content-Length: {}".format(length))
+        return ("\r\n".join(lines) + "\r\n\r\n").encode("iso-8859-1")
+
+    @staticmethod
+    def request_block(req: requests.PreparedRequest) -> bytes:
+        """Build http request block from prepared request"""
+        parts = urlsplit(as_str(req.url or ""))
+        lines = [
+            "{} {} HTTP/1.1".format(as_str(req.method or "GET"), req.path_url)
+        ]
+        if "host" not in req.headers:
+            lines.append("Host: {}".format(parts.netloc))
+        lines.extend(
+            "{}: {}".format(as_str(name), as_str(value))
+            for name, value in req.headers.items()
+        )
+        head = ("\r\n".join(lines) + "\r\n\r\n").encode("iso-8859-1")
+
+        body = req.body or b""
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        elif not isinstance(body, bytes):
+            # streamed upload bodies can't be replayed, skip them
+            body = b""
+        return head + body
+
+
+class WARCEvents(HTTPRequestEvents):
+    """Write each successful downloaded response into warc file,
+    streamed responses are left to the caller (see `WARCWriter.tee()`)"""
+
+    def __init__(self, writer: WARCWriter):
+        self.writer = writer
+
+    def on_success(self, res):
+        # pylint: disable=protected-access
+        if not res._content_consumed:
+            logger.debug("Streamed response is not archived: %s", res.url)
+            return
+        self.writer.write_response(res)
+
+
+def copy_record(warc_path: str, offset: int, length: int, dest: IO[bytes]):
+    """Copy single compressed record from warc file, use offsets from
+    CDX index to get random access to records"""
+    with open(warc_path, "rb") as warc_file:
+        warc_file.seek(offset)
+        remains = length
+        while remains > 0:
+            chunk = warc_file.read(min(CHUNK_SIZE, remains))
+            if not chunk:
+                break
+            dest.write(chunk)
+            remains -= len(chunk)
+
+
+def read_record(warc_path: str, offset: int, length: int) -> bytes:
+    """Return uncompressed record found by offset"""
+    spool: IO[bytes]
+    with tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE) as spool:
+        copy_record(warc_path, offset, length, spool)
+        spool.seek(0)
+        with gzip.GzipFile(fileobj=spool, mode="rb") as member:
+            return member.read()
+
@@ -0,0 +1,247 @@
+"""On-demand profiling of running workers.
+
+Profiler is switched on and off at runtime by signal or redis control key,
+cProfile only collects data inside `scope()` blocks (HTTPRequest.repeat_request
+and events callbacks called from there). tracemalloc traces the whole
+process, snapshot is filtered down to crawler code (pcg, requests, urllib3)
+before dumping. Mode changes are applied by a watcher thread, so profiling
+switched off on an idle worker is dumped too. Results are dumped into file
+tagged with app uuid.
+
+>> profiler = app.get_profiler("/tmp/profiles")
+>> profiler.install_signal_handler()  # kill -USR2 <pid> to toggle
+>> profiler.watch_redis(app.get_redis_pool(uri), "myapp:profiler")
+>> http = HTTPRequest(profiler=profiler)
+
+$ redis-cli set myapp:profiler cprofile  # or tracemalloc, off
+"""
+import os
+import time
+import signal
+import logging
+import cProfile
+import datetime
+import threading
+import contextlib
+import tracemalloc
+from typing import Optional, List
+
+import redis
+import requests
+import urllib3
+
+
+logger = logging.getLogger(__name__)
+
+CPROFILE = "cprofile"
+TRACEMALLOC = "tracemalloc"
+MODES = (CPROFILE, TRACEMALLOC)
+
+
+PACKAGE_DIRS = [
+    os.path.dirname(os.path.abspath(path))
+    for path in (__file__, requests.__file__, urllib3.__file__)
+]
+
+
+def default_trace_filters() -> List[tracemalloc.Filter]:
+    """Keep allocations made in crawler code and http stack"""
+    return [
+        tracemalloc.Filter(True, os.path.join(directory, "*"))
+        for directory in PACKAGE_DIRS
+    ]
+
+
+class Profiler:
+    """Toggleable cProfile/tracemalloc profiler"""
+
+    def __init__(
+        self,
+        directory: str,
+        tag: str = "pcg",
+        trace_filters: Optional[List[tracemalloc.Filter]] = None,
+    ):
+        self.directory = directory
+        self.tag = tag
+        # empty list keeps allocations of the whole process
+        self.trace_filters = (
+            trace_filters
+            if trace_filters is not None
+            else default_trace_filters()
+        )
+
+        self.mode: Optional[str] = None  # currently running profiler
+        self.requested: Optional[str] = None  # profiler we were asked for
+        self.profile: Optional[cProfile.Profile] = None
+        # cProfile can trace one thread at a time, scopes entered by other
+        # threads meanwhile are not profiled
+        self.lock = threading.Lock()
+
+        self.redis_client: Optional[redis.Redis] = None
+        self.control_key: Optional[str] = None
+        self.poll_interval = 0.0
+        self.last_poll = 0.0
+        self.last_control_value: Optional[str] = None
+
+        self.watcher: Optional[threading.Thread] = None
+        self.watcher_stop = threading.Event()
+
+    def request(self, mode: Optional[str]):
+        """Ask to switch profiler mode, None to switch it off.
+        Applied on next scope entry or by watcher thread."""
+        if mode is not None and mode not in MODES:
+            raise ValueError("Unknown profiler mode: {}".format(mode))
+        self.requested = mode
+
+    def install_signal_handler(
+        self, signum: int = signal.SIGUSR2, mode: str = CPROFILE
+    ):
+        """Toggle profiler by signal, should be called from main thread.
+        Handler only records the request, watcher thread applies it."""
+
+        def handler(signum, frame):  # pylint: disable=unused-argument
+            self.request(None if self.requested else mode)
+
+        signal.signal(signum, handler)
+        self.start_watcher()
+
+    def watch_redis(
+        self,
+        redis_client: redis.Redis,
+        control_key: str,
+        poll_interval: float = 5.0,
+    ):
+        """Read mode from redis key (cprofile, tracemalloc, off),
+        key is checked at most once per poll_interval"""
+        self.redis_client = redis_client
+        self.control_key = control_key
+        self.poll_interval = poll_interval
+        self.start_watcher()
+
+    def start_watcher(self, interval: float = 1.0):
+        """Start daemon thread applying requested mode changes, without it
+        they are applied on scope entry only"""
+        if self.watcher is not None and self.watcher.is_alive():
+            return
+        self.watcher_stop.clear()
+
+        def watch():
+            while not self.watcher_stop.wait(interval):
+                try:
+                    self.sync()
+                except Exception:  # pylint: disable=broad-except
+                    logger.exception("Profiler sync failed")
+
+        self.watcher = threading.Thread(
+            target=watch, name="pcg-profiler", daemon=True
+        )
+        self.watcher.start()
+
+    def stop_watcher(self):
+        """Stop watcher thread"""
+        self.watcher_stop.set()
+        if self.watcher is not None:
+            self.watcher.join()
+            self.watcher = None
+
+    def poll_redis(self):
+        """Check redis control key, react only when value changed so
+        signals still work"""
+        if self.redis_client is None:
+            return
+        now = time.monotonic()
+        if now - self.last_poll < self.poll_interval:
+            return
+        self.last_poll = now
+
+        try:
+            value = self.redis_client.get(self.control_key)
+        except redis.exceptions.RedisError as exc:
+            logger.warning("Can't read profiler control key: %s", exc)
+            return
+        if isinstance(value, bytes):
+            value = value.decode("utf-8")
+        if value == self.last_control_value:
+            return
+        self.last_control_value = value
+        self.request(value if value in MODES else None)
+
+    def sync(self):
+        """Start or stop profiler if mode change was requested"""
+        self.poll_redis()
+        if self.requested == self.mode:
+            return
+        # some scope is running, switch on next call
+        if not self.lock.acquire(blocking=False):
+            return
+        try:
+            self.stop()
+            if self.requested == CPROFILE:
+                self.profile = cProfile.Profile()
+            elif self.requested == TRACEMALLOC:
+                tracemalloc.start()
+            self.mode = self.requested
+            if self.mode is not None:
+                logger.info("Profiler started: %s", self.mode)
+        finally:
+            self.lock.release()
+
+    def dump_path(self, extension: str) -> str:
+        """Path to dump profiling results"""
+        os.makedirs(self.directory, exist_ok=True)
+        return os.path.join(
+            self.directory,
+            "{}-{}-{}.{}".format(
+                self.tag,
+                datetime.datetime.utcnow().strftime("%Y%m%d%H%M%S"),
+                os.getpid(),
+                extension,
+            ),
+        )
+
+    def stop(self) -> Optional[str]:
+        """Stop running profiler, dump results, return path to dump"""
+        path = None
+        if self.mode == CPROFILE and self.profile is not None:
+            path = self.dump_path("prof")
+            self.profile.dump_stats(path)
+            self.profile = None
+        elif self.mode == TRACEMALLOC and tracemalloc.is_tracing():
+            path = self.dump_path("tracemalloc")
+            snapshot = tracemalloc.take_snapshot()
+            if self.trace_filters:
+                snapshot = snapshot.filter_traces(self.trace_filters)
+            snapshot.dump(path)
+            tracemalloc.stop()
+
+        if path is not None:
+            logger.info("Profiler %s results: %s", self.mode, path)
+        self.mode = None
+        return path
+
+    def close(self):
+        """Switch profiler off and dump results, call on worker shutdown"""
+        self.stop_watcher()
+        self.requested = None
+        with self.lock:
+            return self.stop()
+
+    @contextlib.contextmanager
+    def scope(self):
+        """Collect cProfile data inside this block if profiling is on"""
+        self.sync()
+        if self.mode != CPROFILE or not self.lock.acquire(blocking=False):
+            yield
+            return
+
+        profile = self.profile
+        try:
+            if profile is not None:
+                profile.enable()
+            try:
+                yield
+            finally:
+                if profile is not None:
+                    profile.disable()
+        finally:
+            self.lock.release()
@@ -2,7 +2,7 @@
 # pylint: disable=missing-class-docstring
 import logging
 from pcg.app import App
-from pcg.app_mixins import AppRedisMixin, AppMongoMixin
+from pcg.app_mixins import AppRedisMixin, AppMongoMixin, AppProfilerMixin
 
 
 DEFAULT_CONFIG = """
@@ -134,3 +134,16 @@ def test_app_redis_mixin(tmp_path):
 
     # check fail of redis availablity
     assert app.check_redis_availability(app.config["redis"]["fail"]) is False
+
+
+def test_app_profiler_mixin(tmp_path):
+    """Test app mixin - profiler"""
+
+    class BasicApp(App, AppProfilerMixin):
+        pass
+
+    app = BasicApp()
+    profiler = app.get_profiler(str(tmp_path))
+
+    assert profiler is app.get_profiler(str(tmp_path))
+    assert profiler.tag == str(app.app_uuid)
@@ -0,0 +1,55 @@
+"""Test content-encoding negotiation and transfer stats"""
+import gzip
+from requests import Request
+import requests_mock  # type: ignore
+
+from pcg.network.http_request import HTTPRequest
+from pcg.network.compression import available_encodings, accept_encoding
+
+
+BODY = b"Hi! " * 10000
+
+
+def test_accept_encoding():
+    """Only decodable encodings are advertised"""
+    encodings = available_encodings()
+    assert encodings[-2:] == ["gzip", "deflate"]
+    assert accept_encoding().endswith("gzip, deflate")
+
+    http = HTTPRequest(config={"request_compression": True})
+    assert http.session.headers["accept-encoding"] == accept_encoding()
+
+
+def test_available_encodings(mocker):
+    """Encodings urllib3 can decode are ordered by preference"""
+    mocker.patch(
+        "pcg.network.compression.ACCEPT_ENCODING", "gzip,deflate,br,zstd"
+    )
+    assert available_encodings() == ["zstd", "br", "gzip", "deflate"]
+
+
+def test_transfer_stats():
+    """Compressed and decompressed bytes are counted"""
+    http = HTTPRequest()
+    compressed = gzip.compress(BODY)
+
+    with requests_mock.Mocker() as req_mock:
+        req_mock.get(
+            "http://somedummydomain.com",
+            content=compressed,
+            headers={"content-encoding": "gzip"},
+        )
+        res = http.repeat_request(Request("GET", "http://somedummydomain.com"))
+        assert res.content == BODY
+
+        res = http.repeat_request(
+            Request("GET", "http://somedummydomain.com"), stream=True
+        )
+        chunks = list(http.iter_content(res, chunk_size=1024))
+        assert b"".join(chunks) == BODY
+
+    stats = http.transfer_stats.as_dict()
+    assert stats["responses"] == 2
+    assert stats["compressed_bytes"] == 2 * len(compressed)
+    assert stats["decompressed_bytes"] == 2 * len(BODY)
+    assert stats["ratio"] > 10
@@ -0,0 +1,237 @@
+"""Test adaptive concurrency controller"""
+import time
+import threading
+import pytest
+from requests import Request
+import requests_mock  # type: ignore
+
+from pcg.network.http_request import HTTPRequest, HTTPRequestEvents
+from pcg.network.concurrency import AIMDController, AIMDEvents, BatchFetcher
+
+
+def test_aimd_controller():
+    """Additive increase, multiplicative decrease"""
+    controller = AIMDController(initial=4, max_limit=6, cooldown=0)
+    url = "http://somedummydomain.com/page"
+
+    for _ in range(4):
+        controller.on_success(url)
+    assert controller.limit(url) == 4  # one slot per window of successes
+    for _ in range(10):
+        controller.on_success(url)
+    assert controller.limit(url) == 6  # capped by max_limit
+
+    controller.on_congestion(url)
+    assert controller.limit(url) == 3
+    for _ in range(5):
+        controller.on_congestion(url)
+    assert controller.limit(url) == 1  # min_limit
+
+    # other hosts are not affected
+    assert controller.limit("http://otherdomain.com") == 4
+
+
+def test_aimd_controller_min_limit():
+    """Host always keeps at least one slot"""
+    with pytest.raises(ValueError):
+        AIMDController(min_limit=0.5)
+
+    controller = AIMDController(initial=0.5)
+    url = "http://somedummydomain.com"
+    assert controller.limit(url) == 1
+    assert controller.acquire(url, timeout=0) is True
+
+
+def test_aimd_controller_cooldown():
+    """Burst of errors decreases limit once"""
+    controller = AIMDController(initial=8, cooldown=60)
+    url = "http://somedummydomain.com"
+    for _ in range(5):
+        controller.on_congestion(url)
+    assert controller.limit(url) == 4
+
+
+def test_aimd_controller_latency():
+    """Slow responses count as congestion"""
+    controller = AIMDController(initial=8, latency_threshold=1.0)
+    controller.on_success("http://somedummydomain.com", latency=2.0)
+    assert controller.limit("http://somedummydomain.com") == 4
+
+
+def test_aimd_slots():
+    """In-flight requests limited per host"""
+    controller = AIMDController(initial=2)
+    url = "http://somedummydomain.com"
+    assert controller.acquire(url, timeout=0) is True
+    assert controller.acquire(url, timeout=0) is True
+    assert controller.acquire(url, timeout=0) is False
+    assert controller.acquire("http://otherdomain.com", timeout=0) is True
+
+    timer = threading.Timer(0.1, controller.release, args=(url,))
+    timer.start()
+    assert controller.acquire(url, timeout=5) is True
+
+
+def test_aimd_events():
+    """Throttling responses decrease host limit"""
+    controller = AIMDController(initial=8)
+    http = HTTPRequest(
+        config={"request_backoff_timeout": 0},
+        events=AIMDEvents(controller),
+        limiter=controller,
+    )
+
+    with requests_mock.Mocker() as req_mock:
+        req_mock.get(
+            "http://somedummydomain.com",
+            [{"status_code": 429}, {"text": "Hi!"}],
+        )
+        res = http.repeat_request(Request("GET", "http://somedummydomain.com"))
+
+    assert res.ok is True
+    assert controller.limit("http://somedummydomain.com") == 4
+    assert controller.hosts["somedummydomain.com"].in_flight == 0
+
+
+def test_aimd_events_limited():
+    """Throttling response not matching download limits still decreases
+    host limit and is retried"""
+    controller = AIMDController(initial=8)
+    http = HTTPRequest(
+        config={
+            "request_backoff_timeout": 0,
+            "request_allowed_content_types": ["application/json"],
+        },
+        events=AIMDEvents(controller),
+        limiter=controller,
+    )
+
+    with requests_mock.Mocker() as req_mock:
+        req_mock.get(
+            "http://somedummydomain.com",
+            [
+                {
+                    "status_code": 503,
+                    "headers": {"content-type": "text/html"},
+                    "text": "<html>Busy</html>",
+                },
+                {
+                    "headers": {"content-type": "application/json"},
+                    "json": {"ok": True},
+                },
+            ],
+        )
+        res = http.repeat_request(Request("GET", "http://somedummydomain.com"))
+
+    assert res.json() == {"ok": True}
+    assert [error["__type"] for error in http.errors] == ["http"]
+    assert controller.limit("http://somedummydomain.com") == 4
+    assert controller.hosts["somedummydomain.com"].in_flight == 0
+
+
+def test_aimd_streamed_slot():
+    """Slot of streamed response is held until body is read or response
+    is closed"""
+    controller = AIMDController(initial=1)
+    http = HTTPRequest(events=AIMDEvents(controller), limiter=controller)
+    url = "http://somedummydomain.com"
+
+    with requests_mock.Mocker() as req_mock:
+        req_mock.get(url, text="Hi!")
+
+        res = http.repeat_request(Request("GET", url), stream=True)
+        state = controller.hosts["somedummydomain.com"]
+        assert state.in_flight == 1
+        assert b"".join(http.iter_content(res)) == b"Hi!"
+        assert state.in_flight == 0
+
+        res = http.repeat_request(Request("GET", url), stream=True)
+        assert state.in_flight == 1
+        res.close()
+        res.close()
+        assert state.in_flight == 0
+
+        # body downloaded by HTTPRequest to check limits
+        res = http.repeat_request(
+            Request("GET", url), limits={"max_body_size": 10}
+        )
+        assert res.text == "Hi!"
+        assert state.in_flight == 0
+
+
+def test_aimd_events_forwarding():
+    """Skip and deadline events are passed further"""
+
+    class Events(HTTPRequestEvents):
+        def __init__(self):
+            self.skipped = []
+            self.deadlines = []
+
+        def on_skip(self, req, res, skip):
+            self.skipped.append(skip)
+
+        def on_deadline(self, req, exc):
+            self.deadlines.append(exc)
+
+    events = Events()
+    controller = AIMDController()
+    http = HTTPRequest(
+        events=AIMDEvents(controller, events), limiter=controller
+    )
+
+    with requests_mock.Mocker() as req_mock:
+        req_mock.get("http://somedummydomain.com", text="x" * 100)
+        res = http.repeat_request(
+            Request("GET", "http://somedummydomain.com"),
+            limits={"max_body_size": 10},
+        )
+
+    assert res is None
+    assert len(events.skipped) == 1
+    assert controller.hosts["somedummydomain.com"].in_flight == 0
+
+    # no free slot within deadline
+    controller = AIMDController(initial=1)
+    http = HTTPRequest(
+        events=AIMDEvents(controller, events), limiter=controller
+    )
+    assert controller.acquire("http://somedummydomain.com") is True
+
+    started = time.monotonic()
+    res = http.repeat_request(
+        Request("GET", "http://somedummydomain.com"), deadline=0.2
+    )
+    assert res is None
+    assert time.monotonic() - started < 1
+    assert len(events.deadlines) == 1
+    assert events.deadlines[0].deadline == 0.2
+    assert controller.hosts["somedummydomain.com"].in_flight == 1
+
+
+def test_batch_fetcher(mocker):
+    """Fetch batch, responses returned in order"""
+    controller = AIMDController(initial=2)
+    fetcher = BatchFetcher(controller, max_workers=4)
+    urls = ["http://somedummydomain.com/{}".format(idx) for idx in range(10)]
+
+    with requests_mock.Mocker() as req_mock:
+        for url in urls:
+            req_mock.get(url, text=url)
+        responses = fetcher.fetch([Request("GET", url) for url in urls])
+        executor = fetcher.executor
+        fetcher.fetch([Request("GET", url) for url in urls])
+
+    assert [res.text for res in responses] == urls
+    assert controller.limit("http://somedummydomain.com") > 2
+
+    # pool is reused between batches, one HTTPRequest per worker thread
+    assert fetcher.executor is executor
+    assert 0 < len(fetcher.instances) <= 4
+    closes = [
+        mocker.patch.object(http.session, "close")
+        for http in fetcher.instances
+    ]
+    fetcher.close()
+    assert fetcher.executor is None
+    for close in closes:
+        close.assert_called_once_with()
@@ -1,10 +1,15 @@
 """Test for http helper module"""
+import io
 import time
+import socket
+import threading
+import pytest
 import requests
 from requests import Request
 import requests_mock  # type: ignore
 
-from pcg.network.http_request import HTTPRequest, HTTPRequestEvents
+from pcg.network.http_request import (
+    HTTPRequest, HTTPRequestEvents, DownloadSkipped)
 
 
 def test_http_request():
@@ -206,3 +211,288 @@ def test_errors():
         assert len(http.errors) == 3
         assert http.last_error()['__type'] == 'exception'
         assert http.last_error()['exception'].response is None
+
+
+class SkipEvents(HTTPRequestEvents):
+    sended = 0
+    skipped = None
+
+    def on_send(self):
+        self.sended += 1
+
+    def on_skip(self, req, res, skip):
+        self.skipped = skip
+
+
+def test_limits_body_size():
+    """Big bodies are skipped without retries"""
+    http = HTTPRequest(
+        config={'request_max_body_size': 100}, events=SkipEvents()
+    )
+
+    with requests_mock.Mocker() as req_mock:
+        # content-length header is checked before download
+        req_mock.get('http://somedummydomain.com/big', content=b'x' * 1000)
+        # size without content-length is checked while downloading
+        req_mock.get(
+            'http://somedummydomain.com/chunked',
+            body=io.BytesIO(b'x' * 1000),
+        )
+        req_mock.get('http://somedummydomain.com/small', text='Hi!')
+
+        for path in ('big', 'chunked'):
+            res = http.repeat_request(
+                Request('GET', 'http://somedummydomain.com/' + path))
+            assert res is None
+            assert http.last_error()['__type'] == 'skipped'
+            assert http.events.skipped.reason == DownloadSkipped.BODY_SIZE
+        assert http.events.sended == 2
+
+        res = http.repeat_request(
+            Request('GET', 'http://somedummydomain.com/small'))
+        assert res.text == 'Hi!'
+
+        # per request limits override config
+        res = http.repeat_request(
+            Request('GET', 'http://somedummydomain.com/big'),
+            limits={'max_body_size': None})
+        assert len(res.content) == 1000
+
+
+def test_limits_content_type():
+    """Content type checked by header or sniffed from first chunk"""
+    http = HTTPRequest(
+        config={
+            'request_domain_limits': {
+                'somedummydomain.com': {
+                    'allowed_content_types': ['text/*', 'application/json'],
+                },
+            },
+        },
+        events=SkipEvents(),
+    )
+
+    with requests_mock.Mocker() as req_mock:
+        req_mock.get(
+            'http://www.somedummydomain.com/file.pdf',
+            headers={'content-type': 'application/pdf'},
+            content=b'%PDF-1.4',
+        )
+        req_mock.get(
+            'http://somedummydomain.com/noheader',
+            body=io.BytesIO(b'\x89PNG\r\n'),
+        )
+        req_mock.get(
+            'http://somedummydomain.com/page',
+            headers={'content-type': 'text/html; charset=utf-8'},
+            text='<html></html>',
+        )
+        req_mock.get(
+            'http://otherdomain.com/file.pdf',
+            headers={'content-type': 'application/pdf'},
+            content=b'%PDF-1.4',
+        )
+
+        assert http.repeat_request(
+            Request('GET', 'http://www.somedummydomain.com/file.pdf')) is None
+        assert http.events.skipped.value == 'application/pdf'
+
+        assert http.repeat_request(
+            Request('GET', 'http://somedummydomain.com/noheader')) is None
+        assert http.events.skipped.value == 'image/png'
+
+        res = http.repeat_request(
+            Request('GET', 'http://somedummydomain.com/page'))
+        assert res.text == '<html></html>'
+
+        # other domains are not limited
+        res = http.repeat_request(
+            Request('GET', 'http://otherdomain.com/file.pdf'))
+        assert res.content == b'%PDF-1.4'
+
+
+def test_limits_error_response():
+    """Error responses are failed and retried, not skipped, limits only
+    cut their body"""
+    http = HTTPRequest(
+        config={
+            'request_backoff_timeout': 0,
+            'request_retries': 2,
+            'request_max_body_size': 100,
+            'request_allowed_content_types': ['application/json'],
+        },
+        events=SkipEvents(),
+    )
+
+    with requests_mock.Mocker() as req_mock:
+        req_mock.get(
+            'http://somedummydomain.com',
+            status_code=503,
+            headers={'content-type': 'text/html'},
+            content=b'x' * 1000,
+        )
+        res = http.repeat_request(Request('GET', 'http://somedummydomain.com'))
+
+    assert res.status_code == 503
+    assert res.content == b'x' * 100
+    assert http.events.sended == 2
+    assert http.events.skipped is None
+    assert [error['__type'] for error in http.errors] == ['http', 'http']
+
+
+def test_limits_download_time():
+    """Slow downloads are aborted"""
+    http = HTTPRequest(
+        config={'request_max_download_time': 0}, events=SkipEvents()
+    )
+
+    with requests_mock.Mocker() as req_mock:
+        req_mock.get('http://somedummydomain.com', text='Hi!')
+        res = http.repeat_request(
+            Request('GET', 'http://somedummydomain.com'))
+
+    assert res is None
+    assert http.events.skipped.reason == DownloadSkipped.DOWNLOAD_TIME
+
+
+@pytest.fixture
+def slow_server():
+    """Local server sending 100 KB body at about 2 KB/s, headers are
+    delayed for /slow-headers path, yields its url"""
+    server = socket.socket()
+    server.bind(('127.0.0.1', 0))
+    server.listen(5)
+    server.settimeout(0.1)
+    stop = threading.Event()
+
+    def serve(conn):
+        with conn:
+            try:
+                if b'/slow-headers' in conn.recv(65536):
+                    stop.wait(3)
+                conn.sendall(
+                    b'HTTP/1.1 200 OK\r\n'
+                    b'Content-Type: text/plain\r\n'
+                    b'Content-Length: 100000\r\n\r\n')
+                for _ in range(500):
+                    if stop.is_set():
+                        return
+                    conn.sendall(b'x' * 200)
+                    time.sleep(0.1)
+            except OSError:  # client gave up
+                pass
+
+    def accept():
+        while not stop.is_set():
+            try:
+                conn, _ = server.accept()
+            except socket.timeout:
+                continue
+            threading.Thread(target=serve, args=(conn,), daemon=True).start()
+
+    thread = threading.Thread(target=accept, daemon=True)
+    thread.start()
+    yield 'http://127.0.0.1:{}/'.format(server.getsockname()[1])
+    stop.set()
+    thread.join()
+    server.close()
+
+
+def test_limits_download_time_slow(slow_server):
+    """Download is aborted in the middle of slow body, waiting for
+    headers counts too"""
+    http = HTTPRequest(
+        config={'request_max_download_time': 1}, events=SkipEvents()
+    )
+
+    for path in ('', 'slow-headers'):
+        current_time = time.time()
+        res = http.repeat_request(Request('GET', slow_server + path))
+        execution_time = time.time() - current_time
+
+        assert res is None
+        assert execution_time < 1.5
+        assert http.events.sended == 1
+        assert http.events.skipped.reason == DownloadSkipped.DOWNLOAD_TIME
+        assert 1 <= http.events.skipped.value < 1.5
+        http.events.sended = 0
+
+
+def test_timeouts():
+    """Connect and read timeouts are passed, cut by deadline"""
+    http = HTTPRequest(
+        config={'request_connect_timeout': 3, 'request_read_timeout': 20}
+    )
+
+    with requests_mock.Mocker() as req_mock:
+        req_mock.get('http://somedummydomain.com', text='Hi!')
+
+        http.repeat_request(Request('GET', 'http://somedummydomain.com'))
+        assert req_mock.last_request.timeout == (3, 20)
+
+        res = http.repeat_request(
+            Request('GET', 'http://somedummydomain.com'), deadline=5)
+        connect, read = req_mock.last_request.timeout
+        assert connect == 3
+        assert 4 < read <= 5
+        assert res.text == 'Hi!'
+
+
+def test_deadline():
+    """Deadline spans all retries and backoff sleeps"""
+
+    class Events(HTTPRequestEvents):
+        sended = 0
+        deadline = None
+
+        def on_send(self):
+            self.sended += 1
+
+        def on_deadline(self, req, exc):
+            self.deadline = exc
+
+    http = HTTPRequest(
+        config={
+            'request_backoff_timeout': 1,
+            'request_retries': 5,
+            'request_deadline': 0.3,
+        },
+        events=Events(),
+    )
+
+    with requests_mock.Mocker() as req_mock:
+        req_mock.get('http://somedummydomain.com', status_code=503)
+
+        current_time = time.time()
+        res = http.repeat_request(Request('GET', 'http://somedummydomain.com'))
+        execution_time = time.time() - current_time
+
+    assert res is None
+    assert execution_time < 1
+    assert http.events.sended == 1
+    assert http.events.deadline.deadline == 0.3
+    assert http.last_error()['__type'] == 'deadline'
+    assert http.errors[0]['__type'] == 'http'
+
+
+def test_deadline_download(slow_server):
+    """Deadline is checked while body is downloaded, slow body doesn't
+    keep single read waiting past it"""
+
+    class Events(HTTPRequestEvents):
+        deadline = None
+
+        def on_deadline(self, req, exc):
+            self.deadline = exc
+
+    http = HTTPRequest(events=Events())
+
+    current_time = time.time()
+    res = http.repeat_request(Request('GET', slow_server), deadline=1)
+    execution_time = time.time() - current_time
+
+    assert res is None
+    assert execution_time < 1.5
+    # configured deadline, not elapsed time
+    assert http.events.deadline.deadline == 1
+    assert http.last_error()['__type'] == 'deadline'
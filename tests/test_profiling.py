@@ -0,0 +1,86 @@
+"""Test on-demand profiler"""
+import os
+import time
+import signal
+import pstats
+import tracemalloc
+from requests import Request
+import requests_mock  # type: ignore
+
+from pcg.network.http_request import HTTPRequest
+from pcg.profiling import Profiler, PACKAGE_DIRS
+
+
+def test_profiler_cprofile(tmp_path):
+    """Profile requests, dump stats when switched off"""
+    profiler = Profiler(str(tmp_path), tag="test-uuid")
+    http = HTTPRequest(profiler=profiler)
+
+    with requests_mock.Mocker() as req_mock:
+        req_mock.get("http://somedummydomain.com", text="Hi!")
+
+        # not profiled
+        http.repeat_request(Request("GET", "http://somedummydomain.com"))
+        assert profiler.mode is None
+
+        profiler.request("cprofile")
+        http.repeat_request(Request("GET", "http://somedummydomain.com"))
+        assert profiler.mode == "cprofile"
+
+    path = profiler.close()
+    assert profiler.mode is None
+    assert os.path.basename(path).startswith("test-uuid-")
+    stats = pstats.Stats(path)
+    assert any(func[2] == "send_with_retries" for func in stats.stats)
+
+
+def test_profiler_signal(tmp_path):
+    """Toggle profiler with signal"""
+    profiler = Profiler(str(tmp_path))
+    profiler.install_signal_handler(signal.SIGUSR2, mode="tracemalloc")
+
+    os.kill(os.getpid(), signal.SIGUSR2)
+    with profiler.scope():
+        assert tracemalloc.is_tracing()
+        http = HTTPRequest()
+        with requests_mock.Mocker() as req_mock:
+            req_mock.get("http://somedummydomain.com", text="Hi!")
+            http.repeat_request(Request("GET", "http://somedummydomain.com"))
+
+    os.kill(os.getpid(), signal.SIGUSR2)
+    with profiler.scope():
+        assert not tracemalloc.is_tracing()
+
+    signal.signal(signal.SIGUSR2, signal.SIG_DFL)
+    profiler.close()
+    dumps = list(tmp_path.glob("pcg-*.tracemalloc"))
+    assert len(dumps) == 1
+    traces = tracemalloc.Snapshot.load(str(dumps[0])).traces
+    assert len(traces) > 0
+    # snapshot is limited to crawler code and http stack
+    for trace in traces:
+        assert any(
+            trace.traceback[0].filename.startswith(directory)
+            for directory in PACKAGE_DIRS
+        )
+
+
+def test_profiler_watcher(tmp_path):
+    """Mode change is applied and dumped without entering scope"""
+    profiler = Profiler(str(tmp_path))
+    profiler.start_watcher(interval=0.01)
+
+    def wait_for(mode):
+        started = time.monotonic()
+        while profiler.mode != mode and time.monotonic() - started < 5:
+            time.sleep(0.01)
+        return profiler.mode == mode
+
+    profiler.request("cprofile")
+    assert wait_for("cprofile")
+    profiler.request(None)
+    assert wait_for(None)
+    assert len(list(tmp_path.glob("pcg-*.prof"))) == 1
+
+    profiler.close()
+    assert profiler.watcher is None
@@ -0,0 +1,131 @@
+"""Test robots.txt cache"""
+import json
+import time
+import threading
+import redis
+import requests_mock  # type: ignore
+
+from pcg.network.robots import RobotsCache
+
+
+ROBOTS = """
+User-agent: *
+Disallow: /private
+Crawl-delay: 2
+
+User-agent: mybot
+Disallow: /
+"""
+
+
+def test_robots_cache():
+    """Robots.txt fetched once per host"""
+    robots = RobotsCache()
+
+    with requests_mock.Mocker() as req_mock:
+        req_mock.get("http://somedummydomain.com/robots.txt", text=ROBOTS)
+        req_mock.get("http://otherdomain.com/robots.txt", status_code=404)
+        req_mock.get("http://forbidden.com/robots.txt", status_code=403)
+
+        assert robots.can_fetch_many(
+            [
+                "http://somedummydomain.com/page",
+                "http://somedummydomain.com/private/page",
+                "http://otherdomain.com/private",
+                "http://forbidden.com/page",
+            ]
+        ) == [True, False, True, False]
+        assert robots.can_fetch("http://somedummydomain.com/", "mybot") is False
+
+        assert robots.crawl_delays(
+            ["http://somedummydomain.com/page", "http://otherdomain.com/"]
+        ) == [2.0, None]
+
+        assert req_mock.call_count == 3
+
+
+def test_robots_server_error():
+    """Server errors disallow crawling, but cached for short time"""
+    robots = RobotsCache(error_ttl=0)
+
+    with requests_mock.Mocker() as req_mock:
+        req_mock.get(
+            "http://somedummydomain.com/robots.txt",
+            [{"status_code": 503}, {"text": ROBOTS}],
+        )
+
+        assert robots.can_fetch("http://somedummydomain.com/page") is False
+        assert robots.can_fetch("http://somedummydomain.com/page") is True
+        assert req_mock.call_count == 2
+
+
+def test_robots_wait(mocker):
+    """Crawl-delay used for pacing"""
+    robots = RobotsCache()
+    sleep = mocker.patch("pcg.network.robots.time.sleep")
+
+    with requests_mock.Mocker() as req_mock:
+        req_mock.get("http://somedummydomain.com/robots.txt", text=ROBOTS)
+
+        assert robots.wait("http://somedummydomain.com/page") == 0
+        assert robots.wait("http://somedummydomain.com/other") > 1.5
+        assert sleep.call_count == 1
+
+
+def test_robots_wait_threads(mocker):
+    """Threads waiting for the same host are paced one after another"""
+    robots = RobotsCache()
+    # waiting threads overlap, but don't sleep whole Crawl-delay
+    real_sleep = time.sleep
+    mocker.patch(
+        "pcg.network.robots.time.sleep", side_effect=lambda _: real_sleep(0.1)
+    )
+    slept = []
+
+    with requests_mock.Mocker() as req_mock:
+        req_mock.get("http://somedummydomain.com/robots.txt", text=ROBOTS)
+        robots.load(["http://somedummydomain.com"])
+
+        def worker():
+            slept.append(robots.wait("http://somedummydomain.com/page"))
+
+        threads = [threading.Thread(target=worker) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    # Crawl-delay: 2
+    assert [round(value) for value in sorted(slept)] == [0, 2, 4, 6]
+
+
+def test_robots_redis(mocker):
+    """Robots.txt shared through redis, redis failures are not fatal"""
+    client = mocker.Mock()
+    pipe = client.pipeline.return_value
+
+    with requests_mock.Mocker() as req_mock:
+        req_mock.get("http://somedummydomain.com/robots.txt", text=ROBOTS)
+        req_mock.get("http://otherdomain.com/robots.txt", status_code=503)
+
+        # shared robots.txt is used without request
+        pipe.execute.return_value = [
+            json.dumps({"status": 200, "text": ROBOTS}),
+            100,
+        ]
+        robots = RobotsCache(redis_client=client, error_ttl=0)
+        assert robots.can_fetch("http://somedummydomain.com/private") is False
+        assert req_mock.call_count == 0
+
+        # redis is down, robots.txt fetched and not shared
+        pipe.execute.side_effect = redis.exceptions.ConnectionError()
+        client.setex.side_effect = redis.exceptions.ConnectionError()
+        robots = RobotsCache(redis_client=client)
+        assert robots.can_fetch("http://somedummydomain.com/page") is True
+        assert req_mock.call_count == 1
+
+        # zero ttl of server errors is not sent to redis
+        client.setex.reset_mock()
+        robots = RobotsCache(redis_client=client, error_ttl=0)
+        assert robots.can_fetch("http://otherdomain.com/page") is False
+        client.setex.assert_not_called()
@@ -0,0 +1,104 @@
+"""Test simhash near-duplicate index"""
+import random
+from pcg.content.simhash import (
+    simhash,
+    hamming_distance,
+    SimHashIndex,
+    RedisBandStorage,
+)
+
+
+# long enough page, so few changed words move only few bits
+RANDOM = random.Random(42)
+PAGE = " ".join(
+    RANDOM.choice(["word{}".format(idx) for idx in range(300)])
+    for _ in range(2000)
+)
+UPDATED_PAGE = "Updated 12:30. " + PAGE + " Ad: buy now"
+
+
+def test_simhash():
+    """Similar texts have close fingerprints"""
+    fingerprint = simhash(PAGE)
+    assert fingerprint == simhash(PAGE)
+    assert hamming_distance(fingerprint, simhash(UPDATED_PAGE)) <= 6
+    assert hamming_distance(fingerprint, simhash("Completely other text")) > 6
+
+
+def test_simhash_index():
+    """Find near duplicates"""
+    index = SimHashIndex(max_distance=6)
+    index.add("first", simhash(PAGE))
+
+    assert index.is_duplicate(simhash(UPDATED_PAGE)) is True
+    assert index.near_duplicates(simhash(PAGE)) == ["first"]
+    assert index.is_duplicate(simhash("Completely other text")) is False
+
+    assert index.check_and_add("second", "Completely other text") is False
+    assert index.check_and_add("third", "Completely other text!") is True
+
+
+def test_simhash_index_batch():
+    """Batch api"""
+    index = SimHashIndex()
+    index.add_many([("first", 0b1111), ("second", 0xFFFF << 48)])
+
+    assert index.near_duplicates_many([0b0111, 0xFFFF << 32, 0xFFFF << 48]) == [
+        ["first"],
+        [],
+        ["second"],
+    ]
+    assert index.is_duplicate_many([0b1, 0xFFFF << 40]) == [True, False]
+
+
+class FakePipeline:
+    """Collect commands, run them on execute like redis pipeline does"""
+
+    def __init__(self, sets):
+        self.sets = sets
+        self.commands = []
+
+    def sadd(self, key, member):
+        self.commands.append(("sadd", key, member))
+
+    def expire(self, key, ttl):
+        self.commands.append(("expire", key, ttl))
+
+    def smembers(self, key):
+        self.commands.append(("smembers", key, None))
+
+    def execute(self):
+        result = []
+        for command, key, arg in self.commands:
+            members = self.sets.setdefault(key, set())
+            if command == "sadd":
+                result.append(int(arg.encode() not in members))
+                members.add(arg.encode())
+            elif command == "smembers":
+                result.append(set(members))
+            else:
+                result.append(True)
+        self.commands = []
+        return result
+
+
+def test_simhash_redis_storage(mocker):
+    """Index shared through redis sets"""
+    sets = {}
+    client = mocker.Mock()
+    client.pipeline.side_effect = lambda transaction: FakePipeline(sets)
+
+    storage = RedisBandStorage(client, prefix="test", ttl=60)
+    index = SimHashIndex(storage=storage)
+    index.add("first", simhash(PAGE))
+
+    assert "test:0:{:x}".format(simhash(PAGE) & 0xFFFF) in sets
+    # another worker sharing the same redis
+    other = SimHashIndex(storage=RedisBandStorage(client, prefix="test"))
+    assert other.near_duplicates(simhash(PAGE)) == ["first"]
+    assert other.is_duplicate_many([simhash(PAGE), 0]) == [True, False]
+
+    # lookup and insert are one transaction
+    assert other.check_and_add("second", "Completely other text") is False
+    assert index.check_and_add("third", "Completely other text") is True
+    client.pipeline.assert_called_with(transaction=True)
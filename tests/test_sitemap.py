@@ -0,0 +1,94 @@
+"""Test streaming sitemap parser"""
+import gzip
+import datetime
+import requests_mock  # type: ignore
+
+from pcg.network.sitemap import SitemapFetcher, parse_sitemap, parse_lastmod
+
+
+SITEMAP_INDEX = b"""<?xml version="1.0" encoding="UTF-8"?>
+<sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">
+  <sitemap>
+    <loc>http://somedummydomain.com/sitemap1.xml.gz</loc>
+    <lastmod>2020-03-05T10:00:00+00:00</lastmod>
+  </sitemap>
+  <sitemap>
+    <loc>http://somedummydomain.com/sitemap2.xml</loc>
+    <lastmod>2020-03-02</lastmod>
+  </sitemap>
+  <sitemap>
+    <loc>http://somedummydomain.com/old.xml</loc>
+    <lastmod>2019-01-01</lastmod>
+  </sitemap>
+</sitemapindex>
+"""
+
+URLSET = """<?xml version="1.0" encoding="UTF-8"?>
+<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">
+{}
+</urlset>
+"""
+URL = """<url><loc>http://somedummydomain.com/{}/{}</loc>
+<lastmod>2020-03-0{}</lastmod><priority>0.5</priority></url>"""
+
+
+def urlset(name, count):
+    """Sitemap with urls, half of them are old"""
+    return URLSET.format(
+        "\n".join(URL.format(name, idx, idx % 2 + 1) for idx in range(count))
+    ).encode("utf-8")
+
+
+def test_parse_lastmod():
+    """W3C datetime formats"""
+    utc = datetime.timezone.utc
+    assert parse_lastmod("2020") == datetime.datetime(2020, 1, 1, tzinfo=utc)
+    assert parse_lastmod("2020-03-01T10:00Z") == datetime.datetime(
+        2020, 3, 1, 10, tzinfo=utc
+    )
+    assert parse_lastmod("2020-03-01T10:00:00+03:00") == datetime.datetime(
+        2020, 3, 1, 7, tzinfo=utc
+    )
+    assert parse_lastmod("yesterday") is None
+
+
+def test_parse_sitemap_by_chunks():
+    """Parser fed by tiny chunks"""
+    data = gzip.compress(urlset("page", 10))
+    chunks = (data[idx : idx + 7] for idx in range(0, len(data), 7))
+
+    entries = list(parse_sitemap(chunks))
+    assert len(entries) == 10
+    assert entries[0].kind == "url"
+    assert entries[0].loc == "http://somedummydomain.com/page/0"
+    assert entries[0].priority == 0.5
+
+
+def test_sitemap_fetcher():
+    """Fetch sitemap index and children, filter by lastmod"""
+    fetcher = SitemapFetcher(max_workers=2)
+
+    with requests_mock.Mocker() as req_mock:
+        req_mock.get(
+            "http://somedummydomain.com/sitemap.xml", content=SITEMAP_INDEX
+        )
+        req_mock.get(
+            "http://somedummydomain.com/sitemap1.xml.gz",
+            content=gzip.compress(urlset("first", 100)),
+        )
+        req_mock.get(
+            "http://somedummydomain.com/sitemap2.xml",
+            content=urlset("second", 50),
+        )
+
+        entries = list(
+            fetcher.iter_urls(
+                "http://somedummydomain.com/sitemap.xml",
+                since=datetime.datetime(2020, 3, 2),
+            )
+        )
+
+        assert len(entries) == 75
+        assert {entry.kind for entry in entries} == {"url"}
+        # old sitemap is not requested at all
+        assert req_mock.call_count == 3
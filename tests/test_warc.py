@@ -0,0 +1,134 @@
+"""Test warc writer"""
+import gzip
+import threading
+from requests import Request
+import requests_mock  # type: ignore
+
+from pcg.network.http_request import HTTPRequest
+from pcg.network.warc import WARCWriter, WARCEvents, read_record, surt
+
+
+def read_index(path):
+    """Return index lines splitted by fields"""
+    with open(str(path)) as index_file:
+        lines = index_file.read().splitlines()
+    assert lines[0].startswith(" CDX")
+    return [line.split(" ") for line in lines[1:]]
+
+
+def test_surt():
+    """Check index keys"""
+    assert surt("http://www.Example.com/Path?q=1") == "com,example)/path?q=1"
+    assert surt("https://sub.example.com") == "com,example,sub)/"
+
+
+def test_warc_writer(tmp_path):
+    """Write responses, then read them back using index"""
+    writer = WARCWriter(str(tmp_path), prefix="test")
+    http = HTTPRequest(events=WARCEvents(writer))
+
+    with requests_mock.Mocker() as req_mock:
+        req_mock.get(
+            "http://somedummydomain.com/page",
+            text="Hi!",
+            headers={"content-type": "text/html; charset=utf-8"},
+        )
+        req_mock.get("http://somedummydomain.com/other", text="Bye!")
+
+        http.repeat_request(Request("GET", "http://somedummydomain.com/page"))
+        http.repeat_request(Request("GET", "http://somedummydomain.com/other"))
+    writer.close()
+
+    warc_files = list(tmp_path.glob("test-*.warc.gz"))
+    assert len(warc_files) == 1
+
+    # whole file is valid multi-member gzip
+    with gzip.open(str(warc_files[0])) as warc_file:
+        content = warc_file.read()
+    assert content.count(b"WARC/1.1\r\n") == 5  # warcinfo + 2 * 2 records
+    assert b"WARC-Type: request" in content
+
+    index = read_index(tmp_path / "test.cdx")
+    assert len(index) == 2
+    assert index[0][0] == "com,somedummydomain)/page"
+    assert index[0][3] == "text/html"
+    assert index[0][4] == "200"
+
+    record = read_record(
+        str(tmp_path / index[0][-1]), int(index[0][-2]), int(index[0][-3])
+    )
+    assert record.startswith(b"WARC/1.1\r\nWARC-Type: response")
+    assert record.endswith(b"\r\n\r\nHi!\r\n\r\n")
+    assert b"Content-Length: 3\r\n" in record
+
+
+def test_warc_rotation(tmp_path):
+    """Files should be rotated after size limit"""
+    with WARCWriter(str(tmp_path), max_file_size=1) as writer:
+        http = HTTPRequest(events=WARCEvents(writer))
+        with requests_mock.Mocker() as req_mock:
+            req_mock.get("http://somedummydomain.com", text="Hi!")
+            for _ in range(3):
+                http.repeat_request(
+                    Request("GET", "http://somedummydomain.com")
+                )
+
+    assert len(list(tmp_path.glob("pcg-*.warc.gz"))) == 3
+    filenames = {line[-1] for line in read_index(tmp_path / "pcg.cdx")}
+    assert len(filenames) == 3
+
+
+def test_warc_streamed_response(tmp_path):
+    """Body of streamed response stays with the caller, tee() archives it
+    while it's read"""
+    writer = WARCWriter(str(tmp_path))
+    http = HTTPRequest(events=WARCEvents(writer))
+
+    with requests_mock.Mocker() as req_mock:
+        req_mock.get("http://somedummydomain.com", text="Hi!")
+        res = http.repeat_request(
+            Request("GET", "http://somedummydomain.com"), stream=True
+        )
+        # on_success didn't touch the body
+        assert read_index(tmp_path / "pcg.cdx") == []
+
+        body = b"".join(writer.tee(res, http.iter_content(res)))
+    writer.close()
+
+    assert body == b"Hi!"
+    index = read_index(tmp_path / "pcg.cdx")
+    assert len(index) == 1
+    record = read_record(
+        str(tmp_path / index[0][-1]), int(index[0][-2]), int(index[0][-3])
+    )
+    assert record.endswith(b"\r\n\r\nHi!\r\n\r\n")
+
+
+def test_warc_threads(tmp_path):
+    """Records written from many threads don't interleave"""
+    writer = WARCWriter(str(tmp_path))
+
+    with requests_mock.Mocker() as req_mock:
+        req_mock.get("http://somedummydomain.com", text="x" * 100000)
+
+        def worker():
+            http = HTTPRequest(events=WARCEvents(writer))
+            for _ in range(5):
+                http.repeat_request(
+                    Request("GET", "http://somedummydomain.com")
+                )
+
+        threads = [threading.Thread(target=worker) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    writer.close()
+
+    index = read_index(tmp_path / "pcg.cdx")
+    assert len(index) == 20
+    for line in index:
+        record = read_record(
+            str(tmp_path / line[-1]), int(line[-2]), int(line[-3])
+        )
+        assert record.endswith(b"x" * 100000 + b"\r\n\r\n")